@@ -12,16 +12,13 @@ version_numb = 'v1.2.5'
 
 # imports
 import sys
-import pandas as pd
+import time
 from argparse import ArgumentParser
-import subprocess
-from ete3 import NCBITaxa
 import re
 
-# local imports
-from ccmetagen import fParseKMA
-from ccmetagen import cTaxInfo # needed in fParseKMA
-from ccmetagen import fNCBItax # needed in fParseKMA
+# pandas, ete3 and the local modules are imported after parsing the arguments,
+# so that --help, --version and usage errors return immediately
+start_time = time.time()
 
 # help
 if len(sys.argv) == 1:
@@ -34,14 +31,9 @@ if len(sys.argv) == 1:
     print ("Ex: CCMetagen.py -i KMA_out/2_mtg.res -o 2_mtg_result")
     print ("")
     print ("")
-    print ("""When running CCMetagen on multiple files in a folder:
-input_dir=KMA_out
-output_dir=CCMetagen_results
-mkdir $output_dir
-for f in $input_dir/*.res; do
-    out=$output_dir/${f/$input_dir\/}
-    CCMetagen.py -i $f -o $out
-done""")
+    print ("""When running CCMetagen on multiple files in a folder, use -ib and -th to
+process them in one run, with 4 samples processed in parallel:
+CCMetagen.py -ib KMA_out -o CCMetagen_results -th 4""")
     print ("")
     print ("For help and options, type: CCMetagen.py -h")
     print ("")
@@ -55,14 +47,30 @@ parser.add_argument('-m', '--mode', default = 'both',
                     help="""what do you want CCMetagen to do?
                     Valid options are 'visual', 'text' or 'both':
                         text: parses kma, filters based on quality and output a text file with taxonomic information and detailed mapping information
-                        visual: parses kma, filters based on quality and output a simplified text file and a krona html file for visualization
+                        visual: parses kma, filters based on quality and output a krona html file for visualization
                         both: outputs both text and visual file formats. Default = both""", required=False)
 
-parser.add_argument('-i', '--res_fp', help='Path to the KMA result (.res file)', required=True)
+parser.add_argument('-i', '--res_fp', help='Path to the KMA result (.res file)', required=False)
+parser.add_argument('-ib', '--batch_input', default = None,
+                    help="""Process several samples in one run, instead of -i. Either a folder containing .res files,
+                    a glob pattern in quotes (e.g. 'KMA_out/*.res') or a tab-separated manifest file with one sample per line:
+                    sample name, path to the .res file and (optional) path to the .mapstat file.
+                    For folders and patterns, the .mapstat file with the same name as the .res file is used if present.
+                    --output_fp is then the output folder""", required=False)
+parser.add_argument('-th', '--threads', default = 1,
+                    help='Number of samples processed in parallel with --batch_input. Default = 1', type=int, required=False)
 parser.add_argument('-o', '--output_fp', default = 'CCMetagen_out',
-                    help='Path to the output file. Default = CCMetagen_out', required=False)
+                    help='Path to the output file (or folder, with --batch_input). Default = CCMetagen_out', required=False)
 parser.add_argument('-r', '--reference_database', default = 'nt',
                     help='Which reference database was used. Options: UNITE, RefSeq or nt. Default = nt', required=False)
+parser.add_argument('-hp', '--header_pattern', default = None,
+                    help="""Regular expression to parse the template names of a custom reference database, named with -r.
+                    It must capture the named groups TaxId and Lineage (a description used in warnings),
+                    e.g. '(?P<TaxId>[^| ]*)[| ](?P<Lineage>[^| ]*)' for nt-like names""", required=False)
+parser.add_argument('-of', '--output_format', default = 'csv',
+                    help="""Format of the text output (--mode text or both): csv (default), or the compressed
+                    columnar formats parquet, feather (both require pyarrow) or hdf5 (requires tables).
+                    CCMetagen_merge.py reads csv files""", required=False)
 parser.add_argument('-ef', '--extended_output_file', default = 'n',
                     help="""Produce an extended output file that includes the percentage of classified reads.
                     Options: y or n. To use this featire, you need to generate the mapstat file when
@@ -78,7 +86,8 @@ parser.add_argument('-du', '--depth_unit', default = 'kma',
                     If you use the 'nc', 'rpm' or 'fr' options, remember to change the default --depth parameter accordingly.
                     Valid options are nc, rpm, fr and kma""", required=False)
 parser.add_argument('-map', '--mapstat', help="""Path to the mapstat file produced with KMA when using the -ef flag (.mapstat).
-                    Required when calculating abundances in RPM or in number of fragments, or when producing the extended_output_file""", required = False)
+                    Required when calculating abundances in RPM or in number of fragments, or when producing the extended_output_file.
+                    Not used with --batch_input (see the manifest file)""", required = False)
 parser.add_argument('-d', '--depth', default = 0.2,
                     help="""minimum sequencing depth. Default = 0.2. The unit corresponds to the one used with --depth_unit
                     If you use --depth_unit different from the default, change this accordingly.
@@ -89,6 +98,10 @@ parser.add_argument('-q', '--query_identity', default = 50,
                     help='Minimum query identity (Phylum level). Default = 50', type=float, required=False)
 parser.add_argument('-p', '--pvalue', default = 0.05,
                     help='Minimum p-value. Default = 0.05.',type=float, required=False)
+parser.add_argument('-cs', '--chunksize', default = 0,
+                    help="""Read the .res file in chunks of this many lines, keeping only the matches that pass
+                    the quality filters, so that memory use depends on the filtered result only.
+                    Useful for very large .res files. Default = 0 (read the whole file at once)""", type=int, required=False)
 
 # similarity thresholds:
 parser.add_argument('-st', '--species_threshold', default = 98.41,
@@ -106,6 +119,26 @@ parser.add_argument('-pt', '--phylum_threshold', default = 0,
 parser.add_argument('-off', '--turn_off_sim_thresholds', default = 'n',
                     help='Turns simularity-based filtering off. Options = y or n. Default = n', required=False)
 
+parser.add_argument('-tf', '--taxfile', default = None,
+                    help="""Path to the taxonomy database: an ete3 taxa.sqlite file or a taxonomy snapshot
+                    built with CCMetagen_build_taxonomy.py (faster). Default = ete3's default database""", required=False)
+
+parser.add_argument('-acc', '--acc2taxid', default = None,
+                    help="""Path to an accession index built with CCMetagen_build_acc2taxid.py. The taxids of templates
+                    named unk_taxid (e.g. sequences added to nt after its taxids were assigned) are looked up
+                    there by accession, instead of leaving these matches without taxonomic ranks""", required=False)
+parser.add_argument('-lt', '--lineage_table', default = None,
+                    help="""Path to the template lineage table of the KMA database, built once with
+                    CCMetagen_build_lineages.py. The lineages of the matches are taken from this table instead
+                    of being parsed from the template names and resolved in every run""", required=False)
+
+parser.add_argument('--offline', action='store_true',
+                    help="""Only check that the taxonomy database (--taxfile) exists and has the expected format,
+                    and stop with an error otherwise. By default, a missing or outdated ete3 database is
+                    downloaded and built by ete3, which needs internet access""", required=False)
+parser.add_argument('--timing', action='store_true',
+                    help='Report the time taken to import modules and check the taxonomy database', required=False)
+
 parser.add_argument('--version', action='version', version=version_numb)
 
 args = parser.parse_args()
@@ -120,6 +153,10 @@ d = args.depth
 p = args.pvalue
 mapstat = args.mapstat
 ef = args.extended_output_file
+taxfile = args.taxfile
+chunksize = args.chunksize
+batch_input = args.batch_input
+threads = args.threads
 
 # taxononomic thresholds:
 off = args.turn_off_sim_thresholds
@@ -166,13 +203,15 @@ else:
 
 ##### Checks:
 
-# Run implicitly ete3.NCBITaxa.__init__() to check for valid taxonomy database
-NCBITaxa()
+# one .res file or a batch
+if (f is None) == (batch_input is None):
+    print ("Use either -i (one .res file) or -ib (a batch of samples).")
+    sys.exit("Try again.")
 
-# Warning if RefDatabase is unknown
-if ref_database not in ("UNITE", "RefSeq","nt"):
-    print (""" Reference database (-r) must be either UNITE, RefSeq or nt.
-           the input is case sensitive and the default is nt.""")
+# the mapstat files of a batch are found next to the .res files or given in the manifest
+if batch_input is not None and mapstat is not None:
+    print ("""-map is only used with -i (one .res file). With -ib, the .mapstat file next to each .res file
+           is used, or give the mapstat files in the third column of a manifest file.""")
     sys.exit("Try again.")
 
 
@@ -182,22 +221,72 @@ if ef not in ("y", "n"):
     sys.exit("Try again.")
 
 
-##### Read input files and output a pandas dataframe
-print ("")
-print ("Reading file %s" %(f))
-print ("")
+# local imports
+import_time = time.time()
+from ccmetagen import fParseKMA
+from ccmetagen import fPipeline
+from ccmetagen import cTaxInfo # needed in fParseKMA
+from ccmetagen import fNCBItax # needed in fParseKMA
+from ccmetagen import fOutput
+import_time = time.time() - import_time
+
+# Check the taxonomy database: a cheap check of the file and its format. If it fails,
+# open it with ete3.NCBITaxa, which downloads or updates it (unless --offline).
+# The handle is then kept and reused for all lineage lookups.
+check_time = time.time()
+taxonomy_problem = fNCBItax.check_taxonomy(taxfile)
+if taxonomy_problem is not None:
+    if args.offline:
+        print (taxonomy_problem)
+        print ("Build it with ete3 (or CCMetagen_build_taxonomy.py) or run CCMetagen without --offline.")
+        sys.exit("Try again.")
+    fNCBItax.get_resolver(taxfile).ncbi
+check_time = time.time() - check_time
+
+if args.timing:
+    print ("Startup: %.3f s to import modules, %.3f s to check the taxonomy database (%.3f s in total)"
+           %(import_time, check_time, time.time() - start_time))
+
+# Check the accession index (only opened here, it is queried when templates have no taxid)
+if args.acc2taxid is not None:
+    acc2taxid_problem = fNCBItax.check_accession_index(args.acc2taxid)
+    if acc2taxid_problem is not None:
+        print (acc2taxid_problem)
+        sys.exit("Try again.")
+
+# Check that the output format can be written
+format_problem = fOutput.check_format(args.output_format)
+if format_problem is not None:
+    print (format_problem)
+    sys.exit("Try again.")
 
-df = pd.read_csv(f, sep='\t', index_col=0, encoding='latin1')
+# Register the template name layout of a custom database
+if args.header_pattern is not None:
+    try:
+        fParseKMA.register_header_parser(ref_database, args.header_pattern)
+    except (ValueError, re.error) as err:
+        print ("Invalid --header_pattern: %s" %(err))
+        sys.exit("Try again.")
+
+# Warning if RefDatabase is unknown
+if ref_database not in fParseKMA.header_parsers:
+    print (""" Reference database (-r) must be either UNITE, RefSeq or nt,
+           or a custom database described with --header_pattern.
+           the input is case sensitive and the default is nt.""")
+    sys.exit("Try again.")
 
-# Rename headers:
-df.index.name = "Closest_match"
+# Check the template lineage table (only opened here, it is queried when the matches get their lineages)
+if args.lineage_table is not None:
+    lineage_table_problem = fParseKMA.check_template_lineages(args.lineage_table, ref_database, taxfile)
+    if lineage_table_problem is not None:
+        print (lineage_table_problem)
+        sys.exit("Try again.")
 
 
-##### Adjust depth to reflect number of bases or RPM if needed:
+##### Depth units:
 
 # number of nucleotides:
 if du == 'nc':
-    df['Depth'] = df.Depth * df.Template_length
     print ("Calculating depth as number of nucleotides, ignoring template length.")
     print ("""Remember to adjust minimum depth value (ex: -d 200) to filter low abundance hits.""")
 
@@ -212,13 +301,6 @@ elif du == 'rpm':
            The default minimum depth is 0.2.
            """)
 
-    with open(mapstat) as mapfile:
-        fragments_line=mapfile.readlines()[3]
-    total_frags = re.split(r'(\t|\n)',fragments_line)[2]
-    df_stats = pd.read_csv(mapstat, sep='\t', index_col=0, header = 6, encoding='latin1')
-    df['Depth'] = 1000000 * df_stats['fragmentCount'] / int(total_frags)
-
-
 # number of PE reads (frags):   
 elif du == 'fr':
     print ("Calculating number of PE reads (fragments)")
@@ -230,12 +312,6 @@ elif du == 'fr':
            Ex: Use -d 2 to only consider matches with 2 fragments or more.
            """)
 
-    with open(mapstat) as mapfile:
-        fragments_line=mapfile.readlines()[3]
-    total_frags = re.split(r'(\t|\n)',fragments_line)[2]
-    df_stats = pd.read_csv(mapstat, sep='\t', index_col=0, header = 6, encoding='latin1')
-    df['Depth'] = df_stats['fragmentCount']
-
 elif du == 'kma':
     print ("")
 
@@ -244,70 +320,38 @@ else:
            --depth_unit option must be nc, rpm, fr or kma. Using 'kma'.""")
     print ("")
 
-##### Quality control + taxonomic assignments
-    
-# quality filter (coverage, query identity, Depth and p-value)
-df = fParseKMA.res_filter(df, ref_database, c, q, d, p)
 
-# add tax info
-df = fParseKMA.populate_w_tax(df, ref_database, st, gt, ft, ot, ct, pt)
+settings = {'mode': mode, 'ref_database': ref_database, 'header_pattern': args.header_pattern,
+            'coverage': c, 'query_identity': q, 'depth': d, 'pvalue': p, 'depth_unit': du,
+            'extended_output': ef, 'thresholds': (st, gt, ft, ot, ct, pt),
+            'taxfile': taxfile, 'chunksize': chunksize, 'output_format': args.output_format,
+            'acc2taxid': args.acc2taxid, 'lineage_table': args.lineage_table}
 
 
-##### Output a file with tax info
-if (mode == 'text') or (mode == 'both'):
+##### Process one sample
+if batch_input is None:
+    fPipeline.process_sample(f, args.output_fp, mapstat, settings)
 
-    # save to file
-    out = args.output_fp + ".ccm.csv"
-    pd.DataFrame.to_csv(df, out)
-
-    print ("csv file saved as %s" %(out))
-    print ("")
 
-##### Output a Krona file
-if (mode == 'visual') or (mode == 'both'):
-    krona_info = df[['Depth','Superkingdom','Kingdom','Phylum','Class','Order','Family','Genus','Species']]
-
-    # remove the unk_xx for better krona representation
-    krona_info = krona_info.replace('unk_.*$', value = '',regex=True)
-
-    # save dataframe to file
-    out1 = args.output_fp + ".tsv"
-    pd.DataFrame.to_csv(krona_info, out1, sep='\t', index=False, header=False)
+##### Or all samples of a batch, with a pool of worker processes
+else:
+    samples = fPipeline.find_samples(batch_input)
+    if not samples:
+        print ("No .res files found in %s" %(batch_input))
+        sys.exit("Try again.")
 
-    # save krona file
-    out2 = args.output_fp + ".html"
+    print ("Processing %i samples with %i worker(s). Results will be saved in %s" %(len(samples), threads, args.output_fp))
+    results = fPipeline.run_batch(samples, args.output_fp, settings, threads)
 
-    shell_command = "ktImportText " + out1 + " -o " + out2
-    subprocess.run(shell_command, shell=True)
+    failed = [(sample, error) for sample, error in results if error is not None]
+    for sample, error in failed:
+        print ("")
+        print ("ERROR processing sample %s:" %(sample))
+        print (error)
 
-    print ("krona file saved as %s" %(out2))
     print ("")
-    
-
-##### Extended format - calculate read mapping stats
-if ef == 'y':
-    print ("calculating read mapping stats...")
-           
-    with open(mapstat) as mapfile:
-        fragments_line=mapfile.readlines()[3]
-    total_frags = re.split(r'(\t|\n)',fragments_line)[2]
-    df_stats = pd.read_csv(mapstat, sep='\t', index_col=0, header = 6, encoding='latin1')
-    
-    # delete species in df_stats that are not in the CCM result dataframe:
-    df_stats_filt = df_stats[df_stats.index.isin(df.index)].copy() # the copy handles the pandas warning
-    df_stats_filt['perc_map'] = df_stats_filt['fragmentCount'] / int(total_frags) * 100
-    total_mapped = sum(df_stats_filt['perc_map'])
-    
-    stats_out = args.output_fp + "_stats.csv"
-    pd.DataFrame.to_csv(df_stats_filt, stats_out )
-    
-    print ("\nStats file saved as %s" %(stats_out))
-    print ("""\nProportion of reads mapped to the database: %f%%\n""" %(total_mapped))
-    
-
-
-
-
-
-
-    
+    print ("Batch summary: %i samples processed successfully, %i failed." %(len(results) - len(failed), len(failed)))
+    if failed:
+        print ("Failed samples: %s" %(", ".join(sample for sample, error in failed)))
+        sys.exit(1)
+    print ("")
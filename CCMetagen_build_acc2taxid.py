@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+CCMetagen_build_acc2taxid.py
+
+Build a disk-backed accession -> taxid index (SQLite) from NCBI's accession2taxid
+files, used to relabel the nt database (benchmarking/rename_nt) without loading
+the whole map in memory.
+
+Download the map from NCBI with:
+wget ftp://ftp.ncbi.nih.gov/pub/taxonomy/accession2taxid/nucl_gb.accession2taxid.gz
+
+USAGE example 1: build the index directly from the compressed NCBI file:
+CCMetagen_build_acc2taxid.py -i nucl_gb.accession2taxid.gz -o acc2taxid.sqlite
+
+USAGE example 2: build it from a two column map (accession.version<tab>taxid):
+CCMetagen_build_acc2taxid.py -i accession_taxid_nucl.map -o acc2taxid.sqlite
+
+"""
+
+import sys
+import time
+from argparse import ArgumentParser
+
+from ccmetagen.cAccessionIndex import AccessionIndex
+
+
+parser = ArgumentParser()
+parser.add_argument('-i', '--input_fp', help="""Path to an NCBI accession2taxid file (e.g. nucl_gb.accession2taxid.gz,
+                    compressed or not) or to a map with two columns: accession.version and taxid""", required=True)
+parser.add_argument('-o', '--output_fp', default = 'acc2taxid.sqlite',
+                    help='Path to the index. Default = acc2taxid.sqlite', required=False)
+parser.add_argument('-cs', '--chunksize', default = 5000000, type=int,
+                    help="""Number of accessions sorted and inserted at a time. Lower it to use less memory.
+                    Default = 5000000""", required=False)
+
+args = parser.parse_args()
+
+if args.chunksize < 1:
+    print ("The chunk size must be at least 1.")
+    sys.exit("Try again.")
+
+print ("")
+print ("Building the accession index from %s" %(args.input_fp))
+start_time = time.time()
+
+n_accessions = AccessionIndex.build(args.input_fp, args.output_fp, args.chunksize)
+
+print ("Done in %.1f s. %i accessions saved in %s" %(time.time() - start_time, n_accessions, args.output_fp))
+print ("")
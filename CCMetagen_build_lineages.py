@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+CCMetagen_build_lineages.py
+
+Build the template lineage table of a KMA database: parse every template name of
+the database once, resolve the lineages of their taxids and save them in a table
+(SQLite) next to the KMA index. CCMetagen.py then takes the lineages of the
+matches from this table (--lineage_table) instead of parsing the template names
+and resolving the lineages in every run.
+
+The template names are read from the .name file written by kma_index.
+Rebuild the table when the database or the taxonomy database is updated.
+
+USAGE example 1: build the table of the nt database (writes nt_CCMetagen.lineages.sqlite):
+CCMetagen_build_lineages.py -n nt_CCMetagen.name -r nt -tf taxonomy.sqlite
+
+Then use it with:
+CCMetagen.py -i sample.res -r nt -tf taxonomy.sqlite -lt nt_CCMetagen.lineages.sqlite -o sample_ccm
+
+USAGE example 2: also look up the taxids of the unk_taxid templates of nt in an accession index:
+CCMetagen_build_lineages.py -n nt_CCMetagen.name -r nt -acc acc2taxid.sqlite
+
+USAGE example 3: a custom database:
+CCMetagen_build_lineages.py -n mydb.name -r mydb -hp '(?P<TaxId>[^| ]*)[| ](?P<Lineage>[^| ]*)'
+
+"""
+
+import re
+import sys
+import time
+from argparse import ArgumentParser
+
+
+parser = ArgumentParser()
+parser.add_argument('-n', '--names_fp', help='Path to the .name file of the KMA database (written by kma_index)', required=True)
+parser.add_argument('-r', '--reference_database', default = "nt",
+                    help='Which reference database was used. Options: UNITE, RefSeq or nt. Default = nt', required=False)
+parser.add_argument('-hp', '--header_pattern', default = None,
+                    help="""Regular expression describing the template names of a custom reference database, named with -r,
+                    as in CCMetagen.py""", required=False)
+parser.add_argument('-o', '--output_fp', default = None,
+                    help='Path to the table. Default = the .name file name without .name, plus .lineages.sqlite', required=False)
+parser.add_argument('-tf', '--taxfile', default = None,
+                    help="""Path to the taxonomy database: an ete3 taxa.sqlite file or a taxonomy snapshot
+                    built with CCMetagen_build_taxonomy.py. Default = ete3's default database""", required=False)
+parser.add_argument('-acc', '--acc2taxid', default = None,
+                    help="""Path to an accession index built with CCMetagen_build_acc2taxid.py, where the taxids of
+                    templates named unk_taxid are looked up""", required=False)
+parser.add_argument('--offline', action='store_true',
+                    help="""Only check that the taxonomy database (--taxfile) exists and has the expected format,
+                    and stop with an error otherwise. By default, a missing or outdated ete3 database is
+                    downloaded and built by ete3, which needs internet access""", required=False)
+parser.add_argument('-cs', '--chunksize', default = 1000000, type=int,
+                    help='Number of template names resolved at a time. Default = 1000000', required=False)
+
+args = parser.parse_args()
+ref_database = args.reference_database
+
+# local imports
+from ccmetagen import fParseKMA
+from ccmetagen import fNCBItax
+
+if args.chunksize < 1:
+    print ("The chunk size must be at least 1.")
+    sys.exit("Try again.")
+
+if args.header_pattern is not None:
+    try:
+        fParseKMA.register_header_parser(ref_database, args.header_pattern)
+    except (ValueError, re.error) as err:
+        print ("Invalid --header_pattern: %s" %(err))
+        sys.exit("Try again.")
+
+if ref_database not in fParseKMA.header_parsers:
+    print ("Reference database (-r) must be either UNITE, RefSeq or nt, or a custom database described with --header_pattern.")
+    sys.exit("Try again.")
+
+# Check the taxonomy database as CCMetagen.py does: if the cheap check fails, open it
+# with ete3.NCBITaxa, which downloads or updates it (unless --offline)
+taxonomy_problem = fNCBItax.check_taxonomy(args.taxfile)
+if taxonomy_problem is not None:
+    if args.offline:
+        print (taxonomy_problem)
+        print ("Build it with ete3 (or CCMetagen_build_taxonomy.py) or run without --offline.")
+        sys.exit("Try again.")
+    fNCBItax.get_resolver(args.taxfile).ncbi
+
+if args.acc2taxid is not None:
+    acc2taxid_problem = fNCBItax.check_accession_index(args.acc2taxid)
+    if acc2taxid_problem is not None:
+        print (acc2taxid_problem)
+        sys.exit("Try again.")
+
+out_fp = args.output_fp
+if out_fp is None:
+    out_fp = (args.names_fp[:-5] if args.names_fp.endswith(".name") else args.names_fp) + ".lineages.sqlite"
+
+print ("")
+print ("Building the template lineage table of %s" %(args.names_fp))
+start_time = time.time()
+
+try:
+    n_names, n_templates, n_taxids = fParseKMA.build_template_lineages(args.names_fp, out_fp, ref_database, args.taxfile,
+                                                                       args.acc2taxid, args.chunksize)
+except IOError as err:
+    print (err)
+    sys.exit("Try again.")
+
+print ("Done in %.1f s. %i of %i templates (%i taxids) saved in %s"
+       %(time.time() - start_time, n_templates, n_names, n_taxids, out_fp))
+if n_templates < n_names:
+    print ("The other templates have no taxid (or one not in the taxonomy database), they will be resolved (or left without taxonomic ranks) in each run.")
+print ("Use it with: CCMetagen.py -r %s -lt %s" %(ref_database, out_fp))
+print ("")
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+CCMetagen_build_taxonomy.py
+
+Compile the NCBI taxonomy into a snapshot of flat arrays that CCMetagen opens with mmap.
+Lineage lookups then need no database queries and the snapshot is shared in memory
+by all CCMetagen processes running on the same node.
+
+USAGE example 1: compile ete3's default taxonomy database (~/.etetoolkit/taxa.sqlite):
+CCMetagen_build_taxonomy.py -o ncbi_taxonomy
+
+USAGE example 2: compile a taxdump downloaded from NCBI:
+CCMetagen_build_taxonomy.py -td taxdump.tar.gz -o ncbi_taxonomy
+
+Then use it with CCMetagen:
+CCMetagen.py -i sample.res -o sample_out -tf ncbi_taxonomy
+
+"""
+
+import sys
+from argparse import ArgumentParser
+
+from ccmetagen.cTaxSnapshot import TaxSnapshot
+
+
+parser = ArgumentParser()
+parser.add_argument('-o', '--output_fp', default = 'ncbi_taxonomy',
+                    help='Path to the snapshot folder. Default = ncbi_taxonomy', required=False)
+parser.add_argument('-tf', '--taxfile', default = None,
+                    help="Path to an ete3 taxa.sqlite database. Default = ete3's default database", required=False)
+parser.add_argument('-td', '--taxdump', default = None,
+                    help="""Path to an NCBI taxdump.tar.gz file, or to a folder containing nodes.dmp, names.dmp and merged.dmp.
+                    If given, it is used instead of the ete3 database""", required=False)
+
+args = parser.parse_args()
+
+if args.taxfile is not None and args.taxdump is not None:
+    print ("Use either --taxfile or --taxdump, not both.")
+    sys.exit("Try again.")
+
+print ("")
+print ("Compiling the taxonomy from %s" %(args.taxdump or args.taxfile or "the default ete3 database"))
+
+n_taxa, n_merged = TaxSnapshot.build(args.output_fp, taxfile=args.taxfile, taxdump=args.taxdump)
+
+print ("Done. %i taxa and %i merged taxids saved in %s" %(n_taxa, n_merged, args.output_fp))
+print ("Use it with: CCMetagen.py -tf %s" %(args.output_fp))
+print ("")
@@ -1,7 +1,17 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-Script to extract sequence reads (or contigs) assigned to a given taxon
+Script to extract sequence reads (or contigs) assigned to a given taxon,
+or to several taxa at once (one fasta file per taxon, reading the frag file once)
+
+USAGE example 1: extract the reads of a family:
+CCMetagen_extract_seqs.py -ifrag sample.frag -iccm sample.ccm.csv -l Family -t Aspergillaceae
+
+USAGE example 2: extract the reads of several genera and of the taxa listed in a file (taxon<tab>rank):
+CCMetagen_extract_seqs.py -ifrag sample.frag -iccm sample.ccm.csv -l Genus -t Candida,Cryptococcus -tl taxa.tsv -o sample
+
+USAGE example 3: extract the reads of all fungi (taxid 4751), whatever the rank of their classification:
+CCMetagen_extract_seqs.py -ifrag sample.frag -iccm sample.ccm.csv -tid 4751
 
 Created on Wed Jun 10 19:37:36 2020
 
@@ -12,8 +22,7 @@ Created on Wed Jun 10 19:37:36 2020
 #imports
 
 import sys
-import pandas as pd
-import csv
+import time
 from argparse import ArgumentParser
 
 
@@ -26,15 +35,36 @@ if len(sys.argv) == 1:
 
 
 parser = ArgumentParser()
-parser.add_argument('-ifrag', '--input_frags', help='The path to the file containing frags (decompressed)', required=True)
+parser.add_argument('-ifrag', '--input_frags', help="""The path to the file containing frags, decompressed or
+                    gzip compressed (.frag.gz). Use - to read it from the standard input""", required=True)
 parser.add_argument('-iccm', '--input_ccmetagen', help='The path to the ccmetagen result csv file', required=True)
-parser.add_argument('-l', '--taxonomic_level', help="""Taxonomic level to merge the results. Options:
-                    Species, Genus, Family, Order, Class, Phylum, Kingdom and Superkingdom""", required=True)
-parser.add_argument('-t', '--taxon', help="""Taxon for which you want to extract sequences. 
-                    Use quotation marks to specify species (e.g. -t 'Escherichia coli')""", required=True)
+parser.add_argument('-l', '--taxonomic_level', help="""Taxonomic level of the taxa given with -t
+                    (and default level of the taxa in -tl). Options:
+                    Species, Genus, Family, Order, Class, Phylum, Kingdom and Superkingdom""", required=False)
+parser.add_argument('-t', '--taxon', help="""Taxon for which you want to extract sequences, or several
+                    taxa separated by commas (one output file per taxon).
+                    Use quotation marks to specify species (e.g. -t 'Escherichia coli')""", required=False)
+parser.add_argument('-tid', '--taxid', help="""Taxid of a clade for which you want to extract sequences, or several
+                    taxids separated by commas (e.g. -tid 4751 for all fungi). The reads of all templates whose
+                    LCA_TaxId belongs to the clade (at any rank) are extracted""", required=False)
+parser.add_argument('-tl', '--taxa_list', help="""File with taxa to extract, one per line, optionally followed
+                    by a tab and the taxonomic level of the taxon (otherwise the level given with -l),
+                    or by a tab and 'taxid' for taxids""", required=False)
+parser.add_argument('-tf', '--taxfile', default = None,
+                    help="""Path to the taxonomy database used to expand taxids into clades: an ete3 taxa.sqlite file
+                    or a snapshot built with CCMetagen_build_taxonomy.py. Default = ete3's default database""", required=False)
 parser.add_argument('-o', '--output_fp', default = 'wanted_taxon_seqs', 
-                    help='Path to the output file. Default = wanted_taxon_seqs', required=False)
+                    help="""Path to the output file. Default = wanted_taxon_seqs.
+                    With several taxa, the files are named <output_fp>_<taxon>.fas""", required=False)
 
+parser.add_argument('-th', '--threads', default = 1, type=int,
+                    help="""Number of processes scanning chunks of the frag file in parallel (only for decompressed
+                    or indexed frag files). Default = 1""", required=False)
+parser.add_argument('--no_index', action='store_true',
+                    help="""Read the whole frag file even if it was indexed with CCMetagen_index_frag.py""", required=False)
+
+parser.add_argument('--timing', action='store_true',
+                    help='Report the time taken to import modules', required=False)
 
 args = parser.parse_args()
 frags_fp  = args.input_frags
@@ -43,6 +73,14 @@ tax_level = args.taxonomic_level
 tax_name = args.taxon
 o_file = args.output_fp + ".fas"
 
+# pandas is imported after parsing the arguments, so that --help and usage errors return immediately
+import_time = time.time()
+import pandas as pd
+import_time = time.time() - import_time
+
+if args.timing:
+    print ("Startup: %.3f s to import modules" %(import_time))
+
 
 # developing and debugging:
 #frags_fp = "test2.frag"
@@ -51,33 +89,90 @@ o_file = args.output_fp + ".fas"
 #tax_level = "Family"
 #o_file = "wanted_seq.fas"
 
-## Get a list for all Closest_match where <tax_rank> == <tax_name>:
-df = pd.read_csv(iccm, sep=',', index_col=0)
-
-wanted_df = df[df[tax_level].str.match(tax_name).fillna(False)]
-
-
-# Then extract sequences for that taxon.
-ofile_good = open(o_file, "w")
-
-cg = 0 #count good reads
-with open(frags_fp) as frags:
-    for line in csv.reader(frags, delimiter = '\t'):
-        match = line[5]
-        seq_id = line[6]
-        seq_read = line[0]
-
-        
-        if match in wanted_df.index.values:
-            ofile_good.write(">"+ seq_id + "\n" + seq_read + "\n")
-            cg += 1  
-
-ofile_good.close()
+# local imports
+from ccmetagen import fExtract
+from ccmetagen import cFragIndex
+from ccmetagen import fNCBItax
+
+
+## The taxa to extract, as (rank, taxon):
+taxa = []
+if tax_name is not None:
+    if tax_level is None:
+        print ("Please specify the taxonomic level of the taxa (-l)")
+        sys.exit("Try again.")
+    taxa += [(tax_level, taxon.strip()) for taxon in tax_name.split(",")]
+if args.taxid is not None:
+    taxa += [('taxid', taxid.strip()) for taxid in args.taxid.split(",")]
+if args.taxa_list is not None:
+    try:
+        taxa += fExtract.read_taxa_list(args.taxa_list, tax_level)
+    except ValueError as err:
+        print (err)
+        sys.exit("Try again.")
+
+taxa = list(dict.fromkeys(taxa)) # without repeated taxa
+if len(taxa) == 0:
+    print ("Please specify the taxa to extract (-t, -tid and/or -tl)")
+    sys.exit("Try again.")
+
+for rank, taxon in taxa:
+    if rank == 'taxid':
+        if not taxon.isdigit():
+            print ("Invalid taxid: %s" %(taxon))
+            sys.exit("Try again.")
+    elif rank not in fExtract.extract_ranks:
+        print ("The taxonomic level of %s (%s) must be one of: %s, or taxid" %(taxon, rank, ", ".join(fExtract.extract_ranks)))
+        sys.exit("Try again.")
+
+# clades need the descendants of the taxids: check the taxonomy database before reading anything
+if any(rank == 'taxid' for rank, taxon in taxa):
+    taxonomy_problem = fNCBItax.check_taxonomy(args.taxfile, clades=True)
+    if taxonomy_problem is not None:
+        print (taxonomy_problem)
+        sys.exit("Try again.")
+
+
+## Map all Closest_match where <tax_rank> == <tax_name> (or whose LCA_TaxId is in the clade of
+## a taxid) to the output file of the taxon:
+dtypes = {rank: str for rank in fExtract.extract_ranks + ['LCA_TaxId']}
+df = pd.read_csv(iccm, sep=',', index_col=0, dtype=dtypes)
+
+try:
+    targets = fExtract.wanted_templates(df, taxa, args.taxfile)
+except ValueError as err:
+    print (err)
+    sys.exit("Try again.")
+
+if len(taxa) == 1:
+    out_fps = [o_file]
+else:
+    out_fps = [fExtract.taxon_output(args.output_fp, rank, taxon) for rank, taxon in taxa]
+
+
+# With an index (CCMetagen_index_frag.py), only the blocks with reads of the templates are read
+index = None
+if not args.no_index and cFragIndex.has_index(frags_fp):
+    try:
+        index = cFragIndex.FragIndex(frags_fp)
+    except ValueError as err:
+        print (err)
+        print ("Reading the whole frag file instead.")
+
+
+# Then extract sequences for all taxa in one pass over the frag file (split in chunks with --threads).
+try:
+    counts = fExtract.extract_reads(frags_fp, targets, out_fps, index, args.threads)
+except IOError as err:
+    print (err)
+    sys.exit("Try again.")
 
 print ("")
 print ("Done.")
-print ("%i sequences classified as %s were saved in the %s file." %(cg, tax_name, o_file))
+for (rank, taxon), out_fp, cg in zip(taxa, out_fps, counts):
+    if rank == 'taxid':
+        taxon = "taxid " + taxon
+    print ("%i sequences classified as %s were saved in the %s file." %(cg, taxon, out_fp))
 print ("Forward and reverse reads were saved to the same file")
 print ("")
 
-
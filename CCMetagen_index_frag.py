@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+CCMetagen_index_frag.py
+
+Index the .frag file of KMA by template, so that CCMetagen_extract_seqs.py only reads
+the parts of the file with reads of the wanted taxa instead of the whole file.
+
+Plain frag files are indexed as they are. Compressed frag files (.frag.gz) are
+rewritten as a block compressed copy (still a valid .gz file) that gets indexed.
+The index is saved in a folder next to the indexed file, <frag file>.ccmidx.
+
+USAGE example 1: index a decompressed frag file:
+CCMetagen_index_frag.py -ifrag sample.frag
+
+USAGE example 2: index a compressed frag file (writes and indexes sample.frag.blocked.gz):
+CCMetagen_index_frag.py -ifrag sample.frag.gz
+
+Then extract reads as usual, the index is used automatically:
+CCMetagen_extract_seqs.py -ifrag sample.frag.blocked.gz -iccm sample.ccm.csv -l Genus -t Candida
+
+"""
+
+import sys
+import time
+from argparse import ArgumentParser
+
+
+parser = ArgumentParser()
+parser.add_argument('-ifrag', '--input_frags', help='The path to the frag file (decompressed or gzip compressed)', required=True)
+parser.add_argument('-o', '--output_fp', default = None,
+                    help="""Path to the block compressed copy of a compressed frag file (or of a decompressed
+                    frag file with --compress). Default = the frag file name without .gz, plus .blocked.gz""", required=False)
+parser.add_argument('-z', '--compress', action='store_true',
+                    help='Also write a block compressed copy of a decompressed frag file, and index the copy', required=False)
+parser.add_argument('-bs', '--block_size', default = 256, type=int,
+                    help="""Size of the blocks, in kb of decompressed frag file. Smaller blocks make extraction of rare taxa
+                    faster, larger blocks compress better. Default = 256""", required=False)
+
+args = parser.parse_args()
+frags_fp = args.input_frags
+
+# local imports
+from ccmetagen import fTextIO
+from ccmetagen.cFragIndex import FragIndex
+
+if frags_fp == "-":
+    print ("The frag file to index must be a file, not the standard input.")
+    sys.exit("Try again.")
+
+if args.block_size < 1:
+    print ("The block size must be at least 1 kb.")
+    sys.exit("Try again.")
+
+with open(frags_fp, 'rb') as frags:
+    compress = args.compress or fTextIO.is_gzip(frags)
+
+out_fp = args.output_fp
+if compress and out_fp is None:
+    out_fp = (frags_fp[:-3] if frags_fp.endswith(".gz") else frags_fp) + ".blocked.gz"
+
+print ("")
+print ("Indexing %s" %(frags_fp))
+start_time = time.time()
+
+try:
+    indexed_fp, n_reads, n_templates, n_blocks = FragIndex.build(frags_fp, out_fp, args.block_size * 1024, compress)
+except (ValueError, IOError) as err:
+    print (err)
+    sys.exit("Try again.")
+
+print ("Done in %.1f s. %i reads of %i templates in %i blocks." %(time.time() - start_time, n_reads, n_templates, n_blocks))
+if compress:
+    print ("Block compressed frag file saved as %s" %(indexed_fp))
+print ("Use it with: CCMetagen_extract_seqs.py -ifrag %s" %(indexed_fp))
+print ("")
@@ -14,14 +14,16 @@ CCMetagen_merge.py -i CCMetagen_folder -t Family
 USAGE example 2: Merge table by species (default) and keep only Cryptococcus and Candida:
 CCMetagen_merge.py -i CCMetagen_folder -kr k -l Genus -tlist Candida,Cryptococcus
 
+USAGE example 3: Keep fungi and bacteria, but remove Saccharomycetaceae and the clade of taxid 1224:
+CCMetagen_merge.py -i CCMetagen_folder --keep Kingdom=Fungi --keep Superkingdom=Bacteria --remove Family=Saccharomycetaceae --remove taxid=1224
+
 @ V.R.Marcelino
 Created on Tue Dec 18 10:00:48 2018
 """
 
 import sys
-import pandas as pd 
+import time
 from argparse import ArgumentParser
-import os
 
 
 parser = ArgumentParser()
@@ -31,7 +33,9 @@ parser.add_argument('-i', '--input_fp', help="""Path to the folder containing CC
 parser.add_argument('-t', '--tax_level', default = 'Species',
                     help="""Taxonomic level to merge the results. Options:
                     Closest_match (includes different genes for the same species),
-                    Species (Default), Genus, Family, Order, Class, Phylum, Kingdom and Superkingdom
+                    Species (Default), Genus, Family, Order, Class, Phylum, Kingdom and Superkingdom.
+                    Several levels can be given, separated by commas (e.g. Species,Genus,Family), or 'all':
+                    the files are then read once and one table is saved per level, named <output_fp>_<level>
                     """, required=False)
 parser.add_argument('-o', '--output_fp', default = 'merged_samples', 
                     help='Path to the output file. Default = merged_samples', required=False)
@@ -46,12 +50,47 @@ parser.add_argument('-l', '--filtering_tax_level', default = 'none',
 parser.add_argument('-tlist', '--taxa_list', default = [], type=str, 
                     help='list taxon names (comma-separated) that you want to keep or exclude', required=False)
 
+# any number of filters, at several levels:
+parser.add_argument('-keep', '--keep', action='append',
+                    help="""Keep only these taxa, given as Rank=name1,name2 (e.g. Kingdom=Fungi,Metazoa)
+                    or as taxid=1234,5678 to keep whole clades (matched against LCA_TaxId, requires the taxonomy database).
+                    Can be used several times: matches of any of the taxa are kept""", required=False)
+parser.add_argument('-remove', '--remove', action='append',
+                    help="""Remove these taxa, given as Rank=name1,name2 or taxid=1234,5678 (whole clades).
+                    Can be used several times, and combined with --keep""", required=False)
+parser.add_argument('-tf', '--taxfile', default = None,
+                    help="""Path to the taxonomy database used to expand taxid filters into clades: an ete3 taxa.sqlite file
+                    or a snapshot built with CCMetagen_build_taxonomy.py. Default = ete3's default database""", required=False)
+parser.add_argument('-of', '--output_format', default = 'csv',
+                    help="""Format of the merged table: csv (default), or the compressed columnar formats
+                    parquet, feather (both require pyarrow) or hdf5 (requires tables)""", required=False)
+parser.add_argument('-lo', '--layout', default = 'wide',
+                    help="""Layout of the merged table: wide (one column per sample, default) or
+                    long (one row per sample and taxon present in the sample: Sample, taxonomy and Depth)""", required=False)
+parser.add_argument('-th', '--threads', default = 1, type=int,
+                    help='Number of files read in parallel. Default = 1', required=False)
+parser.add_argument('-inc', '--incremental', action='store_true',
+                    help="""Keep the depth by taxon of each sample in a folder next to the output
+                    (<output_fp>_merge_store) and, when merging again, only read the result files that are
+                    new or were modified since the last merge. All files are read again when the merge options
+                    (or, with taxid filters, the taxonomy database) change""", required=False)
+parser.add_argument('--timing', action='store_true',
+                    help='Report the time taken to import modules', required=False)
+
 args = parser.parse_args()
 in_folder = args.input_fp
 tax_level = args.tax_level
 output = args.output_fp
 kr = args.keep_or_remove
 
+# pandas is imported after parsing the arguments, so that --help and usage errors return immediately
+import_time = time.time()
+import pandas as pd
+import_time = time.time() - import_time
+
+if args.timing:
+    print ("Startup: %.3f s to import modules" %(import_time))
+
 
 # debugging:
 #in_folder = "/Users/vmar0011/Documents/Programs_dev/03_CCM_nt"
@@ -62,92 +101,84 @@ kr = args.keep_or_remove
 #taxa = ["Escherichia coli"]
 
 
-# Set the taxonomic levels to retain info:
-l = ['Superkingdom','Kingdom','Phylum','Class','Order','Family','Genus','Species','Closest_match']
-
-f4agg = {}
-
-f4agg['Depth']= 'sum'
-for i in l:
-    if i == tax_level:
-        f4agg[i] = 'first'
-        break
+# local imports
+from ccmetagen import fMerge
+from ccmetagen import fOutput
+from ccmetagen import fNCBItax
+
+format_problem = fOutput.check_format(args.output_format)
+if format_problem is not None:
+    print (format_problem)
+    sys.exit("Try again.")
+
+if args.layout not in ("wide", "long"):
+    print ("layout must be wide or long.")
+    sys.exit("Try again.")
+
+# one or more levels; the samples are read once, at the lowest level
+tax_levels = fMerge.merge_ranks if tax_level == 'all' else tax_level.split(",")
+for level in tax_levels:
+    if level not in fMerge.merge_ranks:
+        print ("tax_level must be all, or one or more of: %s" %(", ".join(fMerge.merge_ranks)))
+        sys.exit("Try again.")
+tax_level = max(tax_levels, key=fMerge.merge_ranks.index)
+
+# keep or remove taxa:
+rules = []
+if kr in ("k", "r"):
+    level = args.filtering_tax_level
+    if level not in fMerge.merge_ranks:
+        print ("The filtering level (-l) must be one of: %s" %(", ".join(fMerge.merge_ranks)))
+        sys.exit("Try again.")
+    rules.append(["keep" if kr == "k" else "remove", level, args.taxa_list.split(",")])
+elif kr != "n":
+    print ("kr must be k (keep), r (remove) or n (none).")
+    sys.exit("Try again.")
+
+try:
+    rules += [fMerge.parse_filter_rule("keep", rule) for rule in args.keep or []]
+    rules += [fMerge.parse_filter_rule("remove", rule) for rule in args.remove or []]
+except ValueError as err:
+    print (err)
+    sys.exit("Try again.")
+
+# taxid filters need the descendants of the taxids: check the taxonomy database before reading the samples
+if any(column == 'taxid' for action, column, values in rules):
+    taxonomy_problem = fNCBItax.check_taxonomy(args.taxfile, clades=True)
+    if taxonomy_problem is not None:
+        print (taxonomy_problem)
+        sys.exit("Try again.")
+
+
+# read input files (in parallel with --threads) and get the depth by taxon of each sample
+results = fMerge.find_results(in_folder)
+
+if args.incremental:
+    # only read new or modified files, the other samples come from the merge store
+    store_dir = output + "_merge_store"
+    samples, n_read = fMerge.read_samples_incremental(results, store_dir, tax_level, rules, args.taxfile, args.threads)
+    print ("%i result files read, %i samples taken from %s" %(n_read, len(samples) - n_read, store_dir))
+else:
+    samples = fMerge.read_samples(results, tax_level, rules, args.taxfile, args.threads)
+
+
+# Build the table of all samples at once (taxon info at the end of the table),
+# for each level. Higher levels are summed from the depths at the lowest level
+for level in tax_levels:
+    if level == tax_level:
+        all_samples = fMerge.build_matrix(samples, level)
     else:
-        f4agg[i] = 'first'
-    
-# list of wanted taxa (no depth):
-wanted_taxa = list(f4agg.keys())
-wanted_taxa.remove('Depth')
-
-# create new dataframe:
-all_samples = pd.DataFrame()
-
-
-# read input files and merge results
-for file in os.listdir(in_folder):
-    if file.endswith(".ccm.csv"):
-        
-        sample_name = file.split(".res.ccm.csv")[0]
-        result_fp = os.path.join(in_folder, file)
-
-        df = pd.read_csv(result_fp, sep=',', index_col=0)
-
-        # this is needed because groupby excludes rows with NAs 
-        df = df.fillna("NA")
-        
-        # keep or remove taxa:
-        if kr == "k":
-            level = args.filtering_tax_level
-            taxa = args.taxa_list.split(",")
-            filt_df_str = "df[df['{}'].isin({})]".format(level,taxa)
-            df = eval(filt_df_str)
-            
-        elif kr == "r":
-            level = args.filtering_tax_level
-            taxa = args.taxa_list.split(",")
-            filt_df_str = "df[~df['{}'].isin({})]".format(level,taxa)
-            df = eval(filt_df_str)
-        elif kr == "n":
-            pass        
-        else:
-            print ("kr must be k (keep), r (remove) or n (none).")
-            sys.exit("Try again.")
- 
-        # if tax_level = closest_match, we need an extra column:
-        
-        if tax_level == 'Closest_match':
-            df['Closest_match'] = df.index
-            df.index.name = None # This is needed in modern versions of Pandas (1.0.1)
-
-        depth_by_tax = df.groupby(by=wanted_taxa).agg(f4agg)
-        depth_by_tax.rename(columns={'Depth':sample_name}, inplace=True)
-
-        all_samples = pd.concat([all_samples, depth_by_tax], sort=True, axis=1)
-    
-
-# Group taxon ranks 
-all_samples = all_samples.groupby(by=all_samples.columns, axis = 1).first()
-
-# add taxon info at the end of the table:
-tax_cols_l = list(f4agg.keys())
-tax_cols_l.remove('Depth')
-
-tax_cols = all_samples[tax_cols_l]
-sample_cols = all_samples.drop(columns=tax_cols_l)
-
-all_samples = pd.merge(sample_cols,tax_cols,left_index=True,right_index=True)
-
-# Fill NaN with zeros:
-all_samples = all_samples.fillna(0)
-
-# Remove the artificially added NAs:
-all_samples = all_samples.replace(["NA"], value = "")
-
-
-### Save
-out = output + ".csv"
-pd.DataFrame.to_csv(all_samples, out, index=False)
-
-print ("Done. Abundance estimates for all samples saved as %s" %(out))
+        all_samples = fMerge.build_matrix(fMerge.rollup(samples, level), level)
+
+    ### Save
+    out_base = output if len(tax_levels) == 1 else output + "_" + level
+    out = fMerge.save_table(all_samples, level, out_base, args.output_format, args.layout)
+    if len(tax_levels) > 1:
+        print ("%s table saved as %s" %(level, out))
+
+if len(tax_levels) == 1:
+    print ("Done. Abundance estimates for all samples saved as %s" %(out))
+else:
+    print ("Done.")
 
 
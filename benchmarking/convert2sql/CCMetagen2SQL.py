@@ -17,12 +17,11 @@ import re
 from argparse import ArgumentParser
 import sqlite3
 import pandas as pd
-from ete3 import NCBITaxa
 import numpy # check for NaN
 
-ncbi = NCBITaxa()
 import cTaxInfo # script that define classes used here
 import fNCBItax # script with function to get lineage from taxid
+ncbi = fNCBItax.ncbi # taxonomy handle shared with fNCBItax
 
 parser = ArgumentParser()
 parser.add_argument('-i', '--input_CCMetagen_result', help='The path to the csv file', required=True)
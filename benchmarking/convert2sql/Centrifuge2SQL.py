@@ -11,10 +11,9 @@ Created on Wed Jul 18 08:24:19 2018
 
 from argparse import ArgumentParser
 import sqlite3
-from ete3 import NCBITaxa
-ncbi = NCBITaxa()
 import cTaxInfo # script that define classes used here
 import fNCBItax # script with function to get lineage from taxid
+ncbi = fNCBItax.ncbi # taxonomy handle shared with fNCBItax
 import csv
 
 parser = ArgumentParser()
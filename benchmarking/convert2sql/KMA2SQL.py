@@ -17,10 +17,9 @@ import csv
 import re
 from argparse import ArgumentParser
 import sqlite3
-from ete3 import NCBITaxa
-ncbi = NCBITaxa()
 import cTaxInfo # script that define classes used here
 import fNCBItax # script with function to get lineage from taxid
+ncbi = fNCBItax.ncbi # taxonomy handle shared with fNCBItax
 
 parser = ArgumentParser()
 parser.add_argument('-i', '--input_kma_result', help='The path to the .res or .spa file', required=True)
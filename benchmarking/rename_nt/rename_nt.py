@@ -3,16 +3,56 @@
 """
 Script to add taxids to nt collection
 
+The taxids are looked up in a disk-backed accession index (see
+CCMetagen_build_acc2taxid.py), which is built from the acc2taxid map
+the first time, instead of loading the whole map in memory.
+
+The fasta file can be gzip compressed or read from the standard input, and
+is split at record boundaries into chunks that are relabelled by a pool of
+worker processes (--threads). The output (plain, gzip compressed if it ends
+in .gz, or the standard output) keeps the order of the input, so it can be
+piped straight into kma_index:
+
+rename_nt.py -i nt.fa.gz -o - -th 16 | kma_index -i -- -o nt_CCMetagen
+
 @ V.R.Marcelino
 Created on Fri Dec 28 10:37:56 2018
 """
 
+import gzip
+import locale
+import os
 import re
+import sys
+from argparse import ArgumentParser
+from collections import deque
+from multiprocessing import Pool
+
+# run from the repository without installing CCMetagen: fall back to the ccmetagen package of the repository
+try:
+    import ccmetagen
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+
+from ccmetagen import fTextIO
+from ccmetagen.cAccessionIndex import AccessionIndex
 
 
-# input files:
-acc2taxid_map="accession_taxid_nucl.map"
-nt_in="nt.fa"
+parser = ArgumentParser()
+parser.add_argument('-i', '--input_fp', default = 'nt.fa',
+                    help='Path to the fasta file (can be gzip compressed), or - for the standard input. Default = nt.fa', required=False)
+parser.add_argument('-o', '--output_fp', default = 'nt_w_taxid.fas',
+                    help="""Path to the output fasta file, gzip compressed if it ends in .gz, or - for the
+                    standard output. Default = nt_w_taxid.fas""", required=False)
+parser.add_argument('-m', '--acc2taxid_map', default = 'accession_taxid_nucl.map',
+                    help="""accession2taxid map used to build the accession index if it does not exist.
+                    Default = accession_taxid_nucl.map""", required=False)
+parser.add_argument('-db', '--acc2taxid_index', default = 'accession_taxid_nucl.sqlite',
+                    help='Path to the accession index. Default = accession_taxid_nucl.sqlite', required=False)
+parser.add_argument('-th', '--threads', default = 1, type=int,
+                    help='Number of worker processes relabelling chunks of the fasta file. Default = 1', required=False)
+parser.add_argument('-cs', '--chunk_size', default = 16, type=int,
+                    help='Size of the chunks sent to the workers, in Mb. Default = 16', required=False)
 
 
 # function to  get taxids from accession numbers
@@ -20,31 +60,99 @@ def get_tax_id_dic (accession, accession_dic):
     taxid = accession_dic.get(accession)
     if taxid == None:
         taxid = "unk_taxid"
-    return taxid
+    return str(taxid)
 
 
-# read acc2taxid.map as dictionary
-with open(acc2taxid_map) as a:
-    acc2tax_dic = dict(x.rstrip().split(None, 1) for x in a)
-    
+# Split the fasta file into chunks of whole records (of about chunk_size characters)
+def read_chunks(nt, chunk_size):
+    chunk = []
+    size = 0
+    for line in nt:
+        if size >= chunk_size and line.startswith(">"):
+            yield "".join(chunk)
+            chunk = []
+            size = 0
+        chunk.append(line)
+        size += len(line)
+    if chunk:
+        yield "".join(chunk)
 
-# read fasta file and output new file on the fly
-# although it says 'open', it reads line by line and won't store the whole file in memory.
-    
-new_nt = open('nt_w_taxid.fas', 'w')
 
-with open(nt_in) as nt:
-    for line in nt:
+# accession index and output compression of the worker processes
+acc_index = None
+compress_output = False
+
+def init_worker(index_fp, compress):
+    global acc_index, compress_output
+    # each accession is looked up once, so there is no need for a cache
+    acc_index = AccessionIndex(index_fp, cache=False)
+    compress_output = compress
+
+
+# Add the taxids to the headers of a chunk. Returns the chunk as bytes, gzip compressed if the output is
+def relabel_chunk(chunk):
+    lines = chunk.split("\n")
+    headers = [] # (position in lines, split header)
+    for i, line in enumerate(lines):
         if line.startswith(">"):
-            splited_rec = re.split (r'(>| )', line)
-            accession = splited_rec[2]
-            taxid = get_tax_id_dic(accession,acc2tax_dic)
-            line = ">" + taxid + "|" + "".join(splited_rec[2:])
-        new_nt.write(line)
-            
-new_nt.close()
+            headers.append((i, re.split (r'(>| )', line)))
+
+    acc2tax_dic = acc_index.taxids(splited_rec[2] for i, splited_rec in headers)
+    for i, splited_rec in headers:
+        accession = splited_rec[2]
+        taxid = get_tax_id_dic(accession,acc2tax_dic)
+        lines[i] = ">" + taxid + "|" + "".join(splited_rec[2:])
+
+    chunk = "\n".join(lines).encode(locale.getpreferredencoding(False))
+    if compress_output:
+        chunk = gzip.compress(chunk, compresslevel=6)
+    return chunk
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    # messages go to stderr when the fasta file is written to the standard output
+    log = sys.stderr if args.output_fp == "-" else sys.stdout
+
+    # build the accession index (only once)
+    if not os.path.exists(args.acc2taxid_index):
+        print ("Building the accession index %s from %s" %(args.acc2taxid_index, args.acc2taxid_map), file=log)
+        AccessionIndex.build(args.acc2taxid_map, args.acc2taxid_index)
+
+    # read fasta file and output new file on the fly, one chunk at a time.
+    # compressed outputs are a series of gzip members, one per chunk (a valid .gz file)
+    compress = args.output_fp.endswith(".gz")
+    new_nt = sys.stdout.buffer if args.output_fp == "-" else open(args.output_fp, 'wb')
 
+    # the pool is started before the input is opened: workers forked while a decompressor is
+    # reading from the standard input would keep its input pipe open, and it would never end
+    pool = Pool(args.threads, initializer=init_worker, initargs=(args.acc2taxid_index, compress)) if args.threads > 1 else None
 
-print ("Done!")
+    try:
+        with fTextIO.open_text(args.input_fp) as nt:
+            chunks = read_chunks(nt, args.chunk_size * 1024 * 1024)
+            if pool is not None:
+                # at most 2 chunks per worker are waiting, so the input is not read faster than it is written
+                pending = deque()
+                for chunk in chunks:
+                    pending.append(pool.apply_async(relabel_chunk, (chunk,)))
+                    if len(pending) >= args.threads * 2:
+                        new_nt.write(pending.popleft().get())
+                while pending:
+                    new_nt.write(pending.popleft().get())
+            else:
+                init_worker(args.acc2taxid_index, compress)
+                for chunk in chunks:
+                    new_nt.write(relabel_chunk(chunk))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
 
+    if args.output_fp == "-":
+        new_nt.flush()
+    else:
+        new_nt.close()
 
+    print ("Done!", file=log)
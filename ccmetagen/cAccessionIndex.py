@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Disk-backed accession -> taxid index, built once from NCBI's accession2taxid
+files, to look up the taxids of sequence accessions without loading the whole
+map in memory.
+
+The index is a SQLite file with one table, acc2taxid (accession TEXT PRIMARY
+KEY, taxid INTEGER) WITHOUT ROWID: the accessions (with version, e.g.
+AB123456.1) are stored once, in a B-tree sorted by accession, and lookups only
+read the pages they need. Accessions are looked up in batches, and the results
+are cached (unless the index is opened with cache=False, e.g. to relabel a
+whole database, where each accession is only looked up once).
+
+Build it with CCMetagen_build_acc2taxid.py, from nucl_gb.accession2taxid(.gz)
+(columns accession, accession.version, taxid, gi) or from a two column map
+(accession.version and taxid, e.g. accession_taxid_nucl.map).
+
+"""
+
+import os
+import sqlite3
+from operator import itemgetter
+from urllib.parse import quote
+
+# local imports
+from ccmetagen import fTextIO
+
+
+ACC_INDEX_VERSION = 1
+
+# maximum number of accessions per query (SQLite allows 999 parameters in old versions)
+query_batch_size = 900
+
+
+# Read an accession2taxid file (or a two column map) and yield lists of (accession.version, taxid)
+# of up to chunk_size rows. The columns are found from the header line, if there is one
+def _read_map(map_fp, chunk_size):
+    with fTextIO.open_text(map_fp) as acc_map:
+        first_line = acc_map.readline()
+        first = first_line.rstrip("\r\n").split("\t")
+        if len(first) < 2:
+            first = first_line.split()
+        if 'taxid' in first:
+            acc_col = first.index('accession.version') if 'accession.version' in first else 0
+            taxid_col = first.index('taxid')
+            rows = []
+        else:
+            acc_col, taxid_col = (1, 2) if len(first) >= 4 else (0, 1)
+            rows = [(first[acc_col], int(first[taxid_col]))] if len(first) > taxid_col else []
+
+        for line in acc_map:
+            fields = line.rstrip("\r\n").split("\t")
+            if len(fields) <= taxid_col:
+                fields = line.split()
+                if len(fields) <= taxid_col:
+                    continue
+            rows.append((fields[acc_col], int(fields[taxid_col])))
+            if len(rows) >= chunk_size:
+                yield rows
+                rows = []
+        if rows:
+            yield rows
+
+
+class AccessionIndex():
+
+    def __init__(self, db_fp, cache=True):
+        if not os.path.isfile(db_fp):
+            raise ValueError("Accession index not found: %s. Build it with CCMetagen_build_acc2taxid.py" %(db_fp))
+        self.db_fp = db_fp
+        # read only, so that several processes can share the file
+        self.db = sqlite3.connect("file:%s?mode=ro" %(quote(os.path.abspath(db_fp))), uri=True, check_same_thread=False)
+        try:
+            version = self.db.execute("SELECT value FROM meta WHERE key = 'version';").fetchone()
+        except sqlite3.Error:
+            version = None
+        if version is None or int(version[0]) != ACC_INDEX_VERSION:
+            raise ValueError("%s is not an accession index (format version %s). Rebuild it with CCMetagen_build_acc2taxid.py"
+                             %(db_fp, ACC_INDEX_VERSION))
+        self.cache = {} if cache else None
+
+
+    # taxids of a list of accessions, as a dictionary accession -> taxid (accessions that are
+    # not in the index are left out). Accessions are queried in batches (and cached)
+    def taxids(self, accessions):
+        found = {}
+        missing = []
+        for accession in set(accessions):
+            if self.cache is not None and accession in self.cache:
+                if self.cache[accession] is not None:
+                    found[accession] = self.cache[accession]
+            else:
+                missing.append(accession)
+
+        for i in range(0, len(missing), query_batch_size):
+            batch = missing[i:i + query_batch_size]
+            query = "SELECT accession, taxid FROM acc2taxid WHERE accession IN (%s);" %(",".join("?" * len(batch)))
+            found_batch = dict(self.db.execute(query, batch).fetchall())
+            if self.cache is not None:
+                for accession in batch:
+                    self.cache[accession] = found_batch.get(accession)
+            found.update(found_batch)
+        return found
+
+
+    def taxid(self, accession):
+        return self.taxids([accession]).get(accession)
+
+
+    def close(self):
+        self.db.close()
+
+
+    @staticmethod
+    def build(map_fp, db_fp, chunk_size=5000000):
+        """Build the index db_fp from map_fp (see _read_map). Rows are inserted in sorted
+        chunks of chunk_size, so memory use does not depend on the size of the map.
+        The index is written to a temporary file that replaces db_fp when it is complete.
+        Returns the number of accessions"""
+        tmp_fp = db_fp + ".tmp"
+        if os.path.exists(tmp_fp):
+            os.remove(tmp_fp)
+        db = sqlite3.connect(tmp_fp)
+        try:
+            db.execute("PRAGMA journal_mode = OFF;")
+            db.execute("PRAGMA synchronous = OFF;")
+            db.execute("PRAGMA cache_size = -512000;") # 500 Mb
+            db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);")
+            db.execute("CREATE TABLE acc2taxid (accession TEXT PRIMARY KEY, taxid INTEGER) WITHOUT ROWID;")
+            for rows in _read_map(map_fp, chunk_size):
+                # sorted by accession only (stable), so the last taxid given for an accession wins, like in a dictionary
+                rows.sort(key=itemgetter(0))
+                db.executemany("INSERT OR REPLACE INTO acc2taxid VALUES (?, ?);", rows)
+            n_accessions = db.execute("SELECT COUNT(*) FROM acc2taxid;").fetchone()[0]
+            db.executemany("INSERT INTO meta VALUES (?, ?);",
+                           [('version', str(ACC_INDEX_VERSION)), ('source', os.path.abspath(map_fp)),
+                            ('accessions', str(n_accessions))])
+            db.commit()
+        finally:
+            db.close()
+        os.replace(tmp_fp, db_fp)
+        return n_accessions
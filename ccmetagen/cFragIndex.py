@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Index of a KMA .frag file by template, to extract the reads of a few templates
+without reading the whole file.
+
+The frag file is split into blocks of whole lines (~256 kb by default), and the
+index stores, for each template (Closest_match), the blocks that contain its
+reads. Extraction then only reads (and decompresses) these blocks. Plain .frag
+files are indexed as they are. Compressed files are rewritten as a series of
+independent gzip members, one per block: the result is still a valid .gz file
+(zcat, gunzip and CCMetagen read it as usual), and each block can be
+decompressed on its own.
+
+Build it with CCMetagen_index_frag.py. The index is a folder next to the frag
+file, named <frag file>.ccmidx:
+    index.json         format version, size and modification time of the frag file, block size
+    block_offsets.npy  int64, block i is frag[block_offsets[i]:block_offsets[i+1]] (compressed bytes
+                       if the frag file is block compressed)
+    name_offsets.npy   int64, template i is names.bin[name_offsets[i]:name_offsets[i+1]]
+    names.bin          utf-8 encoded template names, sorted
+    block_ptr.npy      int64, the blocks of template i are blocks[block_ptr[i]:block_ptr[i+1]]
+    blocks.npy         int64, sorted block numbers of each template
+
+"""
+
+import gzip
+import io
+import json
+import os
+import zlib
+from array import array
+
+import numpy as np
+
+# local imports
+from ccmetagen import fExtract
+from ccmetagen import fTextIO
+
+
+INDEX_VERSION = 1
+INDEX_META = "index.json"
+INDEX_SUFFIX = ".ccmidx"
+default_block_size = 256 * 1024
+
+
+# the index folder of a frag file
+def index_path(frags_fp):
+    return frags_fp + INDEX_SUFFIX
+
+
+def has_index(frags_fp):
+    return frags_fp != "-" and os.path.isfile(os.path.join(index_path(frags_fp), INDEX_META))
+
+
+class FragIndex():
+
+    def __init__(self, frags_fp):
+        index_dir = index_path(frags_fp)
+        with open(os.path.join(index_dir, INDEX_META)) as meta_file:
+            meta = json.load(meta_file)
+        if meta.get('version') != INDEX_VERSION:
+            raise ValueError("The index of %s has format version %s, expected %s. Rebuild it with CCMetagen_index_frag.py"
+                             %(frags_fp, meta.get('version'), INDEX_VERSION))
+        stat = os.stat(frags_fp)
+        if stat.st_size != meta['size'] or stat.st_mtime_ns != meta['mtime_ns']:
+            raise ValueError("%s was modified after it was indexed. Rebuild the index with CCMetagen_index_frag.py" %(frags_fp))
+
+        self.frags_fp = frags_fp
+        self.compressed = meta['compressed']
+        self.block_offsets = np.load(os.path.join(index_dir, 'block_offsets.npy'), mmap_mode='r')
+        self.name_offsets = np.load(os.path.join(index_dir, 'name_offsets.npy'), mmap_mode='r')
+        self.names = np.memmap(os.path.join(index_dir, 'names.bin'), dtype=np.uint8, mode='r')
+        self.block_ptr = np.load(os.path.join(index_dir, 'block_ptr.npy'), mmap_mode='r')
+        self.blocks_of = np.load(os.path.join(index_dir, 'blocks.npy'), mmap_mode='r')
+
+
+    def _name(self, i):
+        return self.names[self.name_offsets[i]:self.name_offsets[i + 1]].tobytes()
+
+
+    # position of the template name (bytes) in the sorted names, or -1
+    def _find(self, name):
+        low, high = 0, len(self.name_offsets) - 1
+        while low < high:
+            mid = (low + high) // 2
+            if self._name(mid) < name:
+                low = mid + 1
+            else:
+                high = mid
+        if low < len(self.name_offsets) - 1 and self._name(low) == name:
+            return low
+        return -1
+
+
+    # sorted numbers of the blocks that contain reads of any of the templates
+    def blocks(self, templates):
+        found = []
+        for template in templates:
+            i = self._find(template.encode('utf-8'))
+            if i >= 0:
+                found.append(np.asarray(self.blocks_of[self.block_ptr[i]:self.block_ptr[i + 1]]))
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(found))
+
+
+    # The lines of the frag file in the given blocks (sorted block numbers), read as text like
+    # fTextIO.open_text, in file order.
+    # Consecutive blocks of a plain frag file are read at once
+    def read_lines(self, blocks):
+        offsets = self.block_offsets
+        with open(self.frags_fp, 'rb') as frags:
+            i = 0
+            while i < len(blocks):
+                first = last = int(blocks[i])
+                i += 1
+                if not self.compressed:
+                    while i < len(blocks) and blocks[i] == last + 1:
+                        last += 1
+                        i += 1
+                start, end = int(offsets[first]), int(offsets[last + 1])
+                frags.seek(start)
+                data = frags.read(end - start)
+                if self.compressed:
+                    data = zlib.decompress(data, wbits=31)
+                yield from io.TextIOWrapper(io.BytesIO(data))
+
+
+    @staticmethod
+    def build(frags_fp, out_fp=None, block_size=default_block_size, compress=None):
+        """Index frags_fp (plain or gzip compressed). Compressed files (and plain files
+        if compress is True) are rewritten block by block as out_fp, which is the file
+        that gets indexed. Returns (indexed file, number of reads, templates, blocks)"""
+        with open(frags_fp, 'rb') as frags:
+            is_gzip = fTextIO.is_gzip(frags)
+        if compress is None:
+            compress = is_gzip
+        if compress:
+            if out_fp is None or os.path.abspath(out_fp) == os.path.abspath(frags_fp):
+                raise ValueError("A new file name (out_fp) is needed to write the block compressed frag file")
+            data_fp = out_fp
+        elif is_gzip:
+            raise ValueError("%s is compressed, it can only be indexed as a block compressed copy" %(frags_fp))
+        else:
+            data_fp = frags_fp
+
+        template_blocks = {}
+        block_offsets = array('q', [0])
+        n_reads = 0
+        block = []
+        block_len = 0
+        offset = 0
+        out = open(data_fp, 'wb') if compress else None
+
+        def end_block():
+            nonlocal offset
+            if compress:
+                data = gzip.compress(b"".join(block), compresslevel=6)
+                out.write(data)
+                offset += len(data)
+            else:
+                offset += block_len
+            block_offsets.append(offset)
+
+        try:
+            with fTextIO.open_text(frags_fp, binary=True) as frags:
+                for line in frags:
+                    n_block = len(block_offsets) - 1
+                    template = line.split(b"\t", 6)[fExtract.frag_template_col]
+                    blocks = template_blocks.get(template)
+                    if blocks is None:
+                        template_blocks[template] = array('q', [n_block])
+                    elif blocks[-1] != n_block:
+                        blocks.append(n_block)
+                    block.append(line)
+                    block_len += len(line)
+                    n_reads += 1
+                    if block_len >= block_size:
+                        end_block()
+                        block = []
+                        block_len = 0
+            if block:
+                end_block()
+        finally:
+            if out is not None:
+                out.close()
+
+        names = sorted(template_blocks)
+        name_offsets = np.zeros(len(names) + 1, dtype=np.int64)
+        np.cumsum([len(name) for name in names], out=name_offsets[1:])
+        block_ptr = np.zeros(len(names) + 1, dtype=np.int64)
+        np.cumsum([len(template_blocks[name]) for name in names], out=block_ptr[1:])
+        blocks = np.concatenate([np.frombuffer(template_blocks[name], dtype=np.int64) for name in names]) \
+            if names else np.zeros(0, dtype=np.int64)
+
+        index_dir = index_path(data_fp)
+        os.makedirs(index_dir, exist_ok=True)
+        if os.path.exists(os.path.join(index_dir, INDEX_META)):
+            os.remove(os.path.join(index_dir, INDEX_META))
+        np.save(os.path.join(index_dir, 'block_offsets.npy'), np.frombuffer(block_offsets, dtype=np.int64))
+        np.save(os.path.join(index_dir, 'name_offsets.npy'), name_offsets)
+        np.save(os.path.join(index_dir, 'block_ptr.npy'), block_ptr)
+        np.save(os.path.join(index_dir, 'blocks.npy'), blocks)
+        with open(os.path.join(index_dir, 'names.bin'), 'wb') as names_file:
+            for name in names:
+                names_file.write(name)
+
+        # written last, an index without it is incomplete
+        stat = os.stat(data_fp)
+        with open(os.path.join(index_dir, INDEX_META), 'w') as meta_file:
+            json.dump({'version': INDEX_VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                       'compressed': compress, 'block_size': block_size, 'reads': n_reads,
+                       'templates': len(names), 'blocks': len(block_offsets) - 1}, meta_file, indent=1)
+
+        return data_fp, n_reads, len(names), len(block_offsets) - 1
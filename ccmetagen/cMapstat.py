@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Class that reads the mapping stats produced by KMA with the -ef flag (.mapstat file)
+
+"""
+
+import pandas as pd
+
+
+# column types of a KMA .mapstat table (the index, refSequence, is the template name)
+mapstat_dtypes = {'readCount': 'int64', 'fragmentCount': 'int64', 'mapScoreSum': 'int64',
+                  'refCoveredPositions': 'int64', 'refConsensusSum': 'int64', 'bpTotal': 'int64',
+                  'depthVariance': 'float64', 'nucHighDepthVariance': 'int64', 'depthMax': 'int64',
+                  'snpSum': 'int64', 'insertSum': 'int64', 'deletionSum': 'int64',
+                  'readCountAln': 'int64', 'fragmentCountAln': 'int64'}
+
+
+### Reads a .mapstat file once: the header block ('## key<tab>value' lines, including the
+### total number of fragments) and the table, indexed by template.
+### columns: the table columns to keep (default: all of them)
+class Mapstat():
+
+    def __init__(self, mapstat_fp, columns=None):
+        self.mapstat_fp = mapstat_fp
+        self.header = {}
+
+        with open(mapstat_fp, encoding='latin1') as mapfile:
+            line = mapfile.readline()
+            while line.startswith("##"):
+                key, _, value = line[2:].strip().partition("\t")
+                self.header[key.strip()] = value.strip()
+                line = mapfile.readline()
+
+            # the line after the header block names the columns, e.g. '# refSequence<tab>readCount...'
+            names = line.rstrip("\n").split("\t")
+            usecols = names if columns is None else [names[0]] + list(columns)
+            self.table = pd.read_csv(mapfile, sep='\t', header=None, names=names, index_col=0,
+                                     usecols=usecols, dtype=mapstat_dtypes)
+
+        if 'fragmentCount' not in self.header:
+            raise ValueError("fragmentCount not found in the header of %s" %(mapstat_fp))
+        self.total_frags = int(self.header['fragmentCount'])
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Class that keeps one NCBI taxonomy handle open for the whole process and
+memoizes the lineages it resolves in a bounded LRU cache.
+
+Use fNCBItax.get_resolver() to get the process-wide instance.
+
+"""
+
+import os
+from collections import OrderedDict, namedtuple
+
+from ccmetagen.cTaxSnapshot import TaxSnapshot, is_snapshot
+
+
+# ranks reported by CCMetagen, from the highest to the lowest
+list_of_taxa_ranks = ['superkingdom', 'kingdom', 'phylum', 'class', 'order', 'family','genus', 'species']
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class TaxResolver():
+
+    def __init__(self, taxfile=None, maxsize=100000, batch_size=5000):
+        self.taxfile = taxfile
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+
+        # cache counters
+        self.hits = 0
+        self.misses = 0
+
+        # taxid -> {rank: (rank_taxid, rank_name)}, least recently used first
+        self._cache = OrderedDict()
+        self._ncbi = None
+        self._pid = None
+
+
+    # the taxonomy database is opened once, the first time it is needed.
+    # taxfile can be an ete3 taxa.sqlite or a compiled snapshot (cTaxSnapshot).
+    # sqlite connections cannot be shared with forked worker processes, so a
+    # child process reopens the database (the lineage cache is kept).
+    @property
+    def ncbi(self):
+        if self._ncbi is not None and self._pid != os.getpid() and not isinstance(self._ncbi, TaxSnapshot):
+            self._ncbi = None
+        if self._ncbi is None:
+            self._pid = os.getpid()
+            if is_snapshot(self.taxfile):
+                self._ncbi = TaxSnapshot(self.taxfile)
+            else:
+                # imported here, so that snapshot users never load ete3
+                from ete3 import NCBITaxa
+                if self.taxfile is not None:
+                    self._ncbi = NCBITaxa(self.taxfile)
+                else:
+                    self._ncbi = NCBITaxa()
+        return self._ncbi
+
+
+    def lineage(self, taxid):
+        """Return {rank: (taxid, name)} for the ranks of list_of_taxa_ranks
+        found in the lineage of taxid. Ranks absent from the lineage are not
+        included. The returned dict is shared with the cache, do not modify it.
+        """
+        taxid = int(taxid)
+        ranks = self._cache.get(taxid)
+
+        if ranks is not None:
+            self.hits += 1
+            self._cache.move_to_end(taxid)
+            return ranks
+
+        self.misses += 1
+        ncbi = self.ncbi
+        lineage = ncbi.get_lineage(taxid)
+        ranks = self.ranks_from_lineage(lineage, ncbi.get_rank(lineage),
+                                        ncbi.get_taxid_translator(lineage))
+        self._store(taxid, ranks)
+        return ranks
+
+
+    def lineages(self, taxids):
+        """Resolve many taxids at once. Returns {taxid: {rank: (taxid, name)}}.
+        Taxids not in the cache are resolved with three batched queries
+        (lineages, ranks and names) instead of three queries per taxid.
+        """
+        taxids = set(int(t) for t in taxids)
+        found = {}
+        missing = []
+        for taxid in taxids:
+            ranks = self._cache.get(taxid)
+            if ranks is None:
+                missing.append(taxid)
+            else:
+                self._cache.move_to_end(taxid)
+                found[taxid] = ranks
+        self.hits += len(found)
+        self.misses += len(missing)
+
+        ncbi = self.ncbi
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            tracks = ncbi.get_lineage_translator(batch)
+            nodes = set(node for track in tracks.values() for node in track)
+            ranks = ncbi.get_rank(nodes)
+            names = ncbi.get_taxid_translator(nodes)
+
+            for taxid in batch:
+                if taxid in tracks:
+                    found[taxid] = self.ranks_from_lineage(tracks[taxid], ranks, names)
+                    self._store(taxid, found[taxid])
+                else:
+                    # merged (obsolete) or unknown taxid, let ete3 translate it or raise the error
+                    self.misses -= 1
+                    found[taxid] = self.lineage(taxid)
+
+        return found
+
+
+    def descendants(self, taxids):
+        """Return the set of taxids of the clades of taxids: the taxids themselves
+        (merged taxids are translated) and all their descendants, including
+        intermediate nodes. Descendant sets are not cached.
+        """
+        ncbi = self.ncbi
+        clades = set()
+        for taxid in set(map(int, taxids)):
+            clade = ncbi.get_descendant_taxa(taxid, intermediate_nodes=True)
+            clades.update(clade)
+            # ete3 does not include the taxid itself
+            clades.update(ncbi.get_lineage(taxid)[-1:])
+        return clades
+
+
+    @staticmethod
+    def ranks_from_lineage(lineage, ranks, names):
+        found = {}
+        for node in lineage:
+            rank = ranks.get(node)
+            if rank in list_of_taxa_ranks:
+                found[rank] = (node, names[node])
+        return found
+
+
+    def _store(self, taxid, ranks):
+        self._cache[taxid] = ranks
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._cache))
+
+
+    def cache_clear(self):
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
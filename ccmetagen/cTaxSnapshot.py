@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compiled snapshot of the NCBI taxonomy, stored as flat NumPy arrays indexed by
+taxid and opened with mmap. Lineage lookups are walks over the parent array,
+with no database to open, and processes on the same node share the page cache.
+
+Build it with CCMetagen_build_taxonomy.py. TaxSnapshot implements the subset of
+ete3.NCBITaxa used by CCMetagen, so it can replace it in TaxResolver.
+
+Snapshot directory layout:
+    snapshot.json      format version, rank names and source
+    parent.npy         int32, parent taxid of each taxid (-1 if the taxid does not exist)
+    rank.npy           uint8, index of the rank in snapshot.json 'ranks'
+    name_offsets.npy   int64, names of taxid t are names.bin[name_offsets[t]:name_offsets[t+1]]
+    names.bin          utf-8 encoded scientific names
+    merged.npy         int32 (n, 2), sorted pairs of obsolete -> current taxids
+
+"""
+
+import json
+import os
+import sqlite3
+import tarfile
+import warnings
+
+import numpy as np
+
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_META = "snapshot.json"
+
+
+def is_snapshot(path):
+    return path is not None and os.path.isfile(os.path.join(path, SNAPSHOT_META))
+
+
+class TaxSnapshot():
+
+    def __init__(self, snapshot_dir):
+        with open(os.path.join(snapshot_dir, SNAPSHOT_META)) as meta_file:
+            meta = json.load(meta_file)
+        if meta.get('version') != SNAPSHOT_VERSION:
+            raise ValueError("Taxonomy snapshot %s has format version %s, expected %s. Rebuild it with CCMetagen_build_taxonomy.py"
+                             %(snapshot_dir, meta.get('version'), SNAPSHOT_VERSION))
+
+        self.snapshot_dir = snapshot_dir
+        self.rank_names = meta['ranks']
+        self.parent = np.load(os.path.join(snapshot_dir, 'parent.npy'), mmap_mode='r')
+        self.rank = np.load(os.path.join(snapshot_dir, 'rank.npy'), mmap_mode='r')
+        self.name_offsets = np.load(os.path.join(snapshot_dir, 'name_offsets.npy'), mmap_mode='r')
+        self.names = np.memmap(os.path.join(snapshot_dir, 'names.bin'), dtype=np.uint8, mode='r')
+        merged = np.load(os.path.join(snapshot_dir, 'merged.npy'))
+        self.merged = dict(zip(merged[:, 0].tolist(), merged[:, 1].tolist()))
+
+
+    def _exists(self, taxid):
+        return 0 <= taxid < len(self.parent) and self.parent[taxid] >= 0
+
+
+    def _track(self, taxid):
+        track = [taxid]
+        parent = self.parent
+        while True:
+            up = int(parent[taxid])
+            if up == taxid or up < 0:
+                break
+            track.append(up)
+            taxid = up
+        track.reverse()
+        return track
+
+
+    def _name(self, taxid):
+        start, end = self.name_offsets[taxid], self.name_offsets[taxid + 1]
+        return self.names[start:end].tobytes().decode('utf-8')
+
+
+    # same behaviour as ete3.NCBITaxa.get_lineage, including merged taxids
+    def get_lineage(self, taxid):
+        if not taxid:
+            return None
+        taxid = int(taxid)
+        if not self._exists(taxid):
+            if taxid in self.merged and self._exists(self.merged[taxid]):
+                warnings.warn("taxid %s was translated into %s" %(taxid, self.merged[taxid]))
+                taxid = self.merged[taxid]
+            else:
+                raise ValueError("%s taxid not found" %taxid)
+        return self._track(taxid)
+
+
+    def get_lineage_translator(self, taxids):
+        return {taxid: self._track(taxid) for taxid in set(map(int, taxids)) if self._exists(taxid)}
+
+
+    def get_rank(self, taxids):
+        return {taxid: self.rank_names[self.rank[taxid]] for taxid in set(map(int, taxids)) if self._exists(taxid)}
+
+
+    def get_taxid_translator(self, taxids, try_synonyms=True):
+        id2name = {}
+        for taxid in set(map(int, taxids)):
+            if self._exists(taxid):
+                id2name[taxid] = self._name(taxid)
+            elif try_synonyms and self._exists(self.merged.get(taxid, -1)):
+                id2name[taxid] = self._name(self.merged[taxid])
+        return id2name
+
+
+    # same behaviour as ete3.NCBITaxa.get_descendant_taxa: the descendants of parent, not
+    # including parent itself, or [parent] if it has none. Only the leaves unless intermediate_nodes
+    def get_descendant_taxa(self, parent, intermediate_nodes=False):
+        taxid = self.get_lineage(parent)[-1]
+        parents = np.asarray(self.parent)
+        exists = parents >= 0
+        up = np.where(exists, parents, 0)
+
+        # walk down the tree one level per iteration: a taxon is in the clade if its parent is
+        in_clade = np.zeros(len(parents), dtype=bool)
+        in_clade[taxid] = True
+        while True:
+            below = in_clade | (in_clade[up] & exists)
+            if np.array_equal(below, in_clade):
+                break
+            in_clade = below
+        in_clade[taxid] = False
+
+        if not intermediate_nodes:
+            has_children = np.zeros(len(parents), dtype=bool)
+            has_children[up[exists & (up != np.arange(len(parents)))]] = True
+            in_clade &= ~has_children
+
+        descendants = np.flatnonzero(in_clade).tolist()
+        return descendants if descendants else [taxid]
+
+
+    @staticmethod
+    def build(snapshot_dir, taxfile=None, taxdump=None):
+        """Compile a snapshot from ete3's taxa.sqlite (taxfile, default: ete3's
+        default database) or from an NCBI taxdump (.tar.gz file or a folder
+        with nodes.dmp, names.dmp and merged.dmp)."""
+        if taxdump is not None:
+            nodes, merged = _read_taxdump(taxdump)
+            source = os.path.abspath(taxdump)
+        else:
+            if taxfile is None:
+                from ete3.ncbi_taxonomy.ncbiquery import DEFAULT_TAXADB
+                taxfile = DEFAULT_TAXADB
+            nodes, merged = _read_taxa_sqlite(taxfile)
+            source = os.path.abspath(taxfile)
+
+        max_taxid = max(nodes)
+        parent = np.full(max_taxid + 1, -1, dtype=np.int32)
+        rank = np.zeros(max_taxid + 1, dtype=np.uint8)
+        name_lengths = np.zeros(max_taxid + 1, dtype=np.int64)
+        rank_names = []
+        rank_codes = {}
+        encoded = {}
+
+        for taxid, (parent_taxid, name, rank_name) in nodes.items():
+            if rank_name not in rank_codes:
+                rank_codes[rank_name] = len(rank_names)
+                rank_names.append(rank_name)
+            parent[taxid] = parent_taxid
+            rank[taxid] = rank_codes[rank_name]
+            encoded[taxid] = name.encode('utf-8')
+            name_lengths[taxid] = len(encoded[taxid])
+
+        if len(rank_names) > 256:
+            raise ValueError("Too many distinct ranks (%i) to store as uint8" %(len(rank_names)))
+
+        name_offsets = np.zeros(max_taxid + 2, dtype=np.int64)
+        np.cumsum(name_lengths, out=name_offsets[1:])
+
+        merged_pairs = np.array(sorted(merged.items()), dtype=np.int32).reshape(-1, 2)
+
+        os.makedirs(snapshot_dir, exist_ok=True)
+        np.save(os.path.join(snapshot_dir, 'parent.npy'), parent)
+        np.save(os.path.join(snapshot_dir, 'rank.npy'), rank)
+        np.save(os.path.join(snapshot_dir, 'name_offsets.npy'), name_offsets)
+        np.save(os.path.join(snapshot_dir, 'merged.npy'), merged_pairs)
+        with open(os.path.join(snapshot_dir, 'names.bin'), 'wb') as names_file:
+            for taxid in sorted(encoded):
+                names_file.write(encoded[taxid])
+
+        # written last, a snapshot without it is incomplete
+        with open(os.path.join(snapshot_dir, SNAPSHOT_META), 'w') as meta_file:
+            json.dump({'version': SNAPSHOT_VERSION, 'ranks': rank_names, 'source': source,
+                       'taxa': len(nodes), 'merged': len(merged)}, meta_file, indent=1)
+
+        return len(nodes), len(merged)
+
+
+# taxid -> (parent, name, rank) and old -> new taxids from ete3's taxa.sqlite.
+# ete3 stores the root with an empty parent: it becomes its own parent, as in nodes.dmp
+def _read_taxa_sqlite(taxfile):
+    if not os.path.exists(taxfile):
+        raise ValueError("Cannot open taxonomy database: %s" %(taxfile))
+    db = sqlite3.connect(taxfile)
+    nodes = {}
+    for taxid, parent, spname, rank in db.execute('SELECT taxid, parent, spname, rank FROM species;'):
+        parent = str(parent).strip()
+        nodes[taxid] = (int(parent) if parent.isdigit() else taxid, spname, rank)
+    merged = dict(db.execute('SELECT taxid_old, taxid_new FROM merged;'))
+    db.close()
+    return nodes, merged
+
+
+# same, from the nodes.dmp, names.dmp and merged.dmp files of an NCBI taxdump
+def _read_taxdump(taxdump):
+
+    def dmp_lines(member):
+        if os.path.isdir(taxdump):
+            with open(os.path.join(taxdump, member), encoding='utf-8') as dmp:
+                for line in dmp:
+                    yield line.rstrip('\t|\n').split('\t|\t')
+        else:
+            with tarfile.open(taxdump) as tar:
+                found = [m for m in tar.getmembers() if os.path.basename(m.name) == member]
+                if not found:
+                    raise ValueError("%s not found in %s" %(member, taxdump))
+                for line in tar.extractfile(found[0]):
+                    yield line.decode('utf-8').rstrip('\t|\n').split('\t|\t')
+
+    names = {}
+    for fields in dmp_lines('names.dmp'):
+        if fields[3] == 'scientific name':
+            names[int(fields[0])] = fields[1]
+
+    nodes = {}
+    for fields in dmp_lines('nodes.dmp'):
+        taxid = int(fields[0])
+        nodes[taxid] = (int(fields[1]), names.get(taxid, ''), fields[2])
+
+    merged = {int(fields[0]): int(fields[1]) for fields in dmp_lines('merged.dmp')}
+    return nodes, merged
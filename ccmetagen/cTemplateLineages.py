@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Precomputed lineages of the templates of a KMA database, so that CCMetagen
+does not parse the same template names and resolve the same lineages in every
+run: the templates of the matches of a .res file are looked up in this table instead.
+
+Build it once per database with CCMetagen_build_lineages.py (from the .name
+file written by kma_index). The table is a SQLite file with:
+    meta       format version, reference database, header pattern and sources
+    templates  name TEXT PRIMARY KEY, taxid INTEGER (WITHOUT ROWID)
+    lineages   taxid INTEGER PRIMARY KEY, then the lineage columns of
+               fNCBItax.lineage_table (Superkingdom, Superkingdom_TaxId, ... Species_TaxId)
+
+Only templates whose lineage was resolved are stored. The other templates
+(e.g. unk_taxid) are parsed and resolved in each run as usual.
+
+"""
+
+import os
+import sqlite3
+from urllib.parse import quote
+
+import pandas as pd
+
+# local imports
+from ccmetagen.fNCBItax import lineage_columns
+
+
+LINEAGES_VERSION = 1
+
+# maximum number of templates per query (SQLite allows 999 parameters in old versions)
+query_batch_size = 900
+
+
+class TemplateLineages():
+
+    def __init__(self, db_fp):
+        if not os.path.isfile(db_fp):
+            raise ValueError("Template lineage table not found: %s. Build it with CCMetagen_build_lineages.py" %(db_fp))
+        self.db_fp = db_fp
+        self.db = sqlite3.connect("file:%s?mode=ro" %(quote(os.path.abspath(db_fp))), uri=True, check_same_thread=False)
+        try:
+            self.meta = dict(self.db.execute("SELECT key, value FROM meta;").fetchall())
+        except sqlite3.Error:
+            self.meta = {}
+        if self.meta.get('version') != str(LINEAGES_VERSION) or 'ref_database' not in self.meta:
+            raise ValueError("%s is not a template lineage table (format version %s). Rebuild it with CCMetagen_build_lineages.py"
+                             %(db_fp, LINEAGES_VERSION))
+
+
+    # Query the rows of table (templates or lineages) whose key is in keys, in batches
+    def _select(self, columns, table, key, keys):
+        records = []
+        for i in range(0, len(keys), query_batch_size):
+            batch = keys[i:i + query_batch_size]
+            query = "SELECT %s FROM %s WHERE %s IN (%s);" %(columns, table, key, ",".join("?" * len(batch)))
+            records.extend(self.db.execute(query, batch).fetchall())
+        return records
+
+
+    # taxids of a list of templates, as a dictionary template -> taxid (templates that are
+    # not in the table are left out)
+    def taxids(self, templates):
+        return dict(self._select("name, taxid", "templates", "name", list(templates)))
+
+
+    # Lineages of a list of taxids of the table, as fNCBItax.lineage_table: a taxid-indexed
+    # DataFrame with the names and taxids of each rank
+    def lineage_table(self, taxids):
+        columns = ", ".join('"%s"' %(col) for col in lineage_columns)
+        records = self._select("taxid, " + columns, "lineages", "taxid", [int(taxid) for taxid in taxids])
+
+        table = pd.DataFrame.from_records(records, columns=['TaxId'] + lineage_columns, index='TaxId')
+        taxid_cols = lineage_columns[1::2]
+        table[taxid_cols] = table[taxid_cols].astype('Int64')
+        return table
+
+
+    def close(self):
+        self.db.close()
+
+
+    @staticmethod
+    def write(db_fp, batches, meta):
+        """Write the table db_fp. batches: iterable of (list of (template, taxid), lineage table
+        indexed by taxid, as fNCBItax.lineage_table). meta: dictionary saved in the meta table.
+        The table is written to a temporary file that replaces db_fp when it is complete.
+        Returns the number of templates and of distinct taxids"""
+        tmp_fp = db_fp + ".tmp"
+        if os.path.exists(tmp_fp):
+            os.remove(tmp_fp)
+        db = sqlite3.connect(tmp_fp)
+        try:
+            db.execute("PRAGMA journal_mode = OFF;")
+            db.execute("PRAGMA synchronous = OFF;")
+            db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);")
+            db.execute("CREATE TABLE templates (name TEXT PRIMARY KEY, taxid INTEGER) WITHOUT ROWID;")
+            # (quoted, Order is an SQL keyword)
+            col_types = ", ".join('"%s" %s' %(col, "INTEGER" if col.endswith("_TaxId") else "TEXT") for col in lineage_columns)
+            db.execute("CREATE TABLE lineages (taxid INTEGER PRIMARY KEY, %s);" %(col_types))
+            insert_lineage = "INSERT OR IGNORE INTO lineages VALUES (%s);" %(",".join("?" * (len(lineage_columns) + 1)))
+
+            for templates, lineages in batches:
+                db.executemany("INSERT OR IGNORE INTO templates VALUES (?, ?);", sorted(templates))
+                rows = lineages.astype(object).where(lineages.notna(), None).itertuples(index=True, name=None)
+                db.executemany(insert_lineage, ((int(row[0]),) + row[1:] for row in rows))
+
+            n_templates = db.execute("SELECT COUNT(*) FROM templates;").fetchone()[0]
+            n_taxids = db.execute("SELECT COUNT(*) FROM lineages;").fetchone()[0]
+            meta = dict(meta, version=LINEAGES_VERSION, templates=n_templates, taxids=n_taxids)
+            db.executemany("INSERT INTO meta VALUES (?, ?);", [(key, str(value)) for key, value in meta.items()])
+            db.commit()
+        finally:
+            db.close()
+        os.replace(tmp_fp, db_fp)
+        return n_templates, n_taxids
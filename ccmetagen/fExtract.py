@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Functions to extract the reads (or contigs) assigned to one or more taxa
+from the .frag file of KMA (used by CCMetagen_extract_seqs.py).
+
+The templates of each requested taxon are taken from the CCMetagen results and
+put in a dictionary template -> output files, so the .frag file is read once
+for all taxa, with one dictionary lookup per read. Taxa are selected by exact
+name at one rank, or by taxid: the clade is expanded once into the set of its
+taxids (including unnamed intermediate ranks), matched against LCA_TaxId.
+
+The .frag file can be gzip compressed (.frag.gz, as written by KMA) or read
+from the standard input ('-'), see fTextIO.open_text.
+
+With threads > 1, decompressed and indexed frag files are split into chunks of
+whole lines (byte ranges, or groups of blocks of the index) that are scanned by
+a pool of worker processes. Each worker writes the reads of its chunk to part
+files, which are appended to the output files in the order of the chunks, so
+the output is the same as with a single scan.
+
+"""
+
+import locale
+import os
+import re
+import shutil
+from multiprocessing import Pool
+
+import numpy as np
+
+# local imports
+from ccmetagen import fNCBItax
+from ccmetagen import fTextIO
+
+
+# ranks that can be used to select the taxa (by name), or 'taxid' to select whole clades
+extract_ranks = ['Superkingdom','Kingdom','Phylum','Class','Order','Family','Genus','Species']
+
+# columns of a .frag line: read sequence (0), template (5) and read name (6)
+frag_seq_col = 0
+frag_template_col = 5
+frag_name_col = 6
+
+
+# Read a list of taxa to extract: one taxon per line, optionally followed by a tab and its rank
+# (default_rank is used otherwise) or 'taxid' for a taxid. Returns a list of (rank, taxon)
+def read_taxa_list(taxa_fp, default_rank=None):
+    taxa = []
+    with open(taxa_fp) as taxa_file:
+        for line in taxa_file:
+            line = line.rstrip("\r\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            taxon, _, rank = line.partition("\t")
+            rank = rank.strip() or default_rank
+            if rank is not None and rank.lower() == 'taxid':
+                rank = 'taxid'
+            if rank is None:
+                raise ValueError("No rank given for %s in %s" %(taxon, taxa_fp))
+            taxa.append((rank, taxon.strip()))
+    return taxa
+
+
+# Name of the output file of a taxon, when several taxa are extracted
+def taxon_output(out_base, rank, taxon):
+    if rank == 'taxid':
+        taxon = "taxid_" + taxon
+    return "%s_%s.fas" %(out_base, re.sub(r'[^\w.-]+', '_', taxon))
+
+
+# Map the templates of the CCMetagen results (dataframe indexed by Closest_match, with the
+# ranks and LCA_TaxId read as strings) to the taxa that they belong to. taxa: list of (rank, taxon).
+# Names must be equal to the name at that rank. Taxids are expanded into their clades with the
+# taxonomy database taxfile, and match the templates whose LCA_TaxId is in the clade.
+# Returns a dictionary template -> tuple of the indices (in taxa) of its taxa
+def wanted_templates(df, taxa, taxfile=None):
+    targets = {}
+    for i, (rank, taxon) in enumerate(taxa):
+        if rank == 'taxid':
+            clade = fNCBItax.get_resolver(taxfile).descendants([taxon])
+            matches = df['LCA_TaxId'].isin([str(taxid) for taxid in clade])
+        elif rank in df.columns:
+            matches = df[rank] == taxon
+        else:
+            raise ValueError("Rank %s not found in the CCMetagen results" %(rank))
+        for template in df.index[matches.to_numpy()].unique():
+            targets.setdefault(template, []).append(i)
+    return {template: tuple(indices) for template, indices in targets.items()}
+
+
+# Write each read of the frag lines to the output files of its template
+def _write_reads(lines, targets, outs, counts):
+    for line in lines:
+        fields = line.rstrip("\r\n").split("\t")
+        indices = targets.get(fields[frag_template_col])
+        if indices is None:
+            continue
+        record = ">" + fields[frag_name_col] + "\n" + fields[frag_seq_col] + "\n"
+        for i in indices:
+            outs[i].write(record)
+            counts[i] += 1
+
+
+# The lines of frags_fp between the byte positions start and end (both at the start of a line)
+def _range_lines(frags_fp, start, end):
+    encoding = locale.getpreferredencoding(False)
+    with open(frags_fp, 'rb') as frags:
+        frags.seek(start)
+        position = start
+        while position < end:
+            line = frags.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line.decode(encoding)
+
+
+# Split frags_fp into chunks that can be scanned in parallel: lists of block numbers of the
+# index that contain reads of the targets or, without index, byte ranges of whole lines of a
+# decompressed file. Returns None if the file cannot be split (compressed or standard input)
+def frag_chunks(frags_fp, targets, n_chunks, index=None, min_chunk_size=1 << 20):
+    if index is not None:
+        blocks = index.blocks(targets)
+        if len(blocks) == 0:
+            return []
+        return [('blocks', chunk) for chunk in np.array_split(blocks, min(n_chunks, len(blocks))) if len(chunk)]
+
+    if frags_fp == "-":
+        return None
+    with open(frags_fp, 'rb') as frags:
+        if fTextIO.is_gzip(frags):
+            return None
+        size = os.fstat(frags.fileno()).st_size
+        n_chunks = max(1, min(n_chunks, size // min_chunk_size))
+        bounds = [0]
+        for i in range(1, n_chunks):
+            # move each boundary to the start of the next line
+            frags.seek(size * i // n_chunks - 1)
+            frags.readline()
+            bounds.append(min(frags.tell(), size))
+        bounds.append(size)
+    bounds = sorted(set(bounds))
+    return [('range', (start, end)) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+# targets and frag file of the worker processes, sent once to each worker
+_targets = {}
+_frags_fp = None
+_index = None
+
+def _init_extract(targets, frags_fp, indexed):
+    global _targets, _frags_fp, _index
+    _targets = targets
+    _frags_fp = frags_fp
+    if indexed:
+        from ccmetagen.cFragIndex import FragIndex
+        _index = FragIndex(frags_fp)
+
+
+# Scan one chunk (from frag_chunks) and write its reads to part files of the outputs.
+# Returns the part files and the number of reads in each of them
+def _extract_chunk(job):
+    n_chunk, (kind, chunk), out_fps = job
+    if kind == 'blocks':
+        lines = _index.read_lines(chunk)
+    else:
+        lines = _range_lines(_frags_fp, chunk[0], chunk[1])
+    part_fps = ["%s.part%i" %(out_fp, n_chunk) for out_fp in out_fps]
+    counts = [0] * len(out_fps)
+    outs = [open(part_fp, "w") for part_fp in part_fps]
+    try:
+        _write_reads(lines, _targets, outs, counts)
+    finally:
+        for out in outs:
+            out.close()
+    return part_fps, counts
+
+
+# Scan the chunks with a pool of worker processes, appending their part files to the outputs in order
+def _extract_parallel(frags_fp, targets, out_fps, chunks, index, threads):
+    counts = [0] * len(out_fps)
+    jobs = [(n_chunk, chunk, out_fps) for n_chunk, chunk in enumerate(chunks)]
+    outs = [open(out_fp, "wb") for out_fp in out_fps]
+    pool = Pool(min(threads, len(jobs)), initializer=_init_extract, initargs=(targets, frags_fp, index is not None))
+    try:
+        for part_fps, part_counts in pool.imap(_extract_chunk, jobs):
+            for i, part_fp in enumerate(part_fps):
+                with open(part_fp, "rb") as part:
+                    shutil.copyfileobj(part, outs[i], 1 << 20)
+                os.remove(part_fp)
+                counts[i] += part_counts[i]
+    finally:
+        pool.close()
+        pool.join()
+        for out in outs:
+            out.close()
+    return counts
+
+
+# Read the .frag file once and write each read to the output files of its template.
+# targets: dictionary template -> indices of out_fps (see wanted_templates).
+# index: a cFragIndex.FragIndex of the frag file, to read only the blocks with reads of the targets.
+# threads: number of worker processes scanning chunks of the file (see frag_chunks)
+# Returns the number of reads saved to each output file
+def extract_reads(frags_fp, targets, out_fps, index=None, threads=1):
+    if threads > 1:
+        chunks = frag_chunks(frags_fp, targets, threads * 4, index)
+        if chunks is not None and len(chunks) > 1:
+            return _extract_parallel(frags_fp, targets, out_fps, chunks, index, threads)
+
+    counts = [0] * len(out_fps)
+    outs = [open(out_fp, "w") for out_fp in out_fps]
+    try:
+        if index is not None:
+            _write_reads(index.read_lines(index.blocks(targets)), targets, outs, counts)
+        else:
+            with fTextIO.open_text(frags_fp) as frags:
+                _write_reads(frags, targets, outs, counts)
+    finally:
+        for out in outs:
+            out.close()
+    return counts
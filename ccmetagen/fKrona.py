@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Write Krona charts directly from a pandas dataframe, without KronaTools.
+
+The chart is the same as the one produced by ktImportText: the Krona
+javascript (ccmetagen/data/krona_template.html, taken unchanged from
+KronaTools 2.7, see the license in the file) followed by the taxonomy tree
+with the summed magnitude of each node.
+
+"""
+
+import os
+from xml.sax.saxutils import escape
+
+
+krona_template_fp = os.path.join(os.path.dirname(__file__), 'data', 'krona_template.html')
+
+
+# one node of the tree: child nodes by name, summed magnitude and the magnitude assigned
+# to the node itself (i.e. not to any of its children)
+def _new_node():
+    return {'children': {}, 'magnitude': 0.0, 'unassigned': 0.0}
+
+
+# Build the tree from a dataframe whose first column is the magnitude (Depth) and the
+# next columns are the lineage, from the highest to the lowest rank.
+# Like ktImportText, empty names are skipped
+def krona_tree(krona_info):
+    root = _new_node()
+    for row in krona_info.itertuples(index=False):
+        magnitude = float(row[0])
+        node = root
+        node['magnitude'] += magnitude
+        for name in row[1:]:
+            if not isinstance(name, str) or name == "":
+                continue
+            node = node['children'].setdefault(name, _new_node())
+            node['magnitude'] += magnitude
+        node['unassigned'] += magnitude
+    return root
+
+
+def _node_lines(name, node, depth, lines):
+    indent = " " * depth
+    lines.append('%s<node name="%s">' %(indent, escape(name, {'"': "&quot;"})))
+    lines.append('%s <magnitude><val>%.15g</val></magnitude>' %(indent, node['magnitude']))
+    if node['children'] and node['unassigned'] > 0:
+        lines.append('%s <magnitudeUnassigned><val>%.15g</val></magnitudeUnassigned>' %(indent, node['unassigned']))
+    for child_name, child in node['children'].items():
+        _node_lines(child_name, child, depth + 1, lines)
+    lines.append('%s</node>' %(indent))
+
+
+# Write the Krona html file out_fp for the dataframe krona_info (see krona_tree).
+# dataset is the chart name shown by Krona
+def write_krona(krona_info, out_fp, dataset):
+    lines = ['  <div style="display:none">',
+             '  <krona collapse="true" key="true">',
+             '   <attributes magnitude="magnitude">',
+             '    <attribute display="Total">magnitude</attribute>',
+             '    <attribute display="Unassigned">magnitudeUnassigned</attribute>',
+             '   </attributes>',
+             '   <datasets>',
+             '    <dataset>%s</dataset>' %(escape(dataset)),
+             '   </datasets>']
+    _node_lines("all", krona_tree(krona_info), 0, lines)
+    lines.append('  </krona>')
+    lines.append('</div></body></html>')
+
+    with open(krona_template_fp, encoding='utf-8') as template:
+        head = template.read()
+
+    with open(out_fp, 'w', encoding='utf-8') as out:
+        out.write(head)
+        out.write("\n".join(lines))
+        out.write("\n")
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Functions to merge the results of CCMetagen for several samples into one
+sample x taxon abundance table (used by CCMetagen_merge.py).
+
+Each sample is reduced to its (taxon, depth) pairs, and the table is built once
+from all of them: the depths as sparse columns (absent taxa are not stored) and
+the taxonomy columns once per taxon.
+
+"""
+
+import csv
+import json
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+# local imports
+from ccmetagen import fNCBItax
+from ccmetagen import fOutput
+
+
+# ranks that can be used to merge the results, from the highest to the lowest
+merge_ranks = ['Superkingdom','Kingdom','Phylum','Class','Order','Family','Genus','Species','Closest_match']
+
+
+# the taxonomy columns of a merged table at tax_level: all ranks down to tax_level
+def taxon_columns(tax_level):
+    return merge_ranks[:merge_ranks.index(tax_level) + 1]
+
+
+# Sum the depth of a CCMetagen result (dataframe indexed by Closest_match) by taxon.
+# Returns a Series indexed by the taxonomy columns of tax_level.
+# Undefined ranks must be filled with "NA" first (groupby excludes rows with NAs)
+def sample_depths(df, tax_level):
+    # if tax_level = closest_match, we need an extra column:
+    if tax_level == 'Closest_match':
+        df['Closest_match'] = df.index
+        df.index.name = None # This is needed in modern versions of Pandas (1.0.1)
+
+    return df.groupby(by=taxon_columns(tax_level))['Depth'].sum()
+
+
+##### Taxon filters
+
+# A filter rule is [action, column, values]: action is 'keep' or 'remove', and column is either
+# a rank of merge_ranks (values are taxon names) or 'taxid' (values are taxids, each standing
+# for its whole clade, matched against the LCA_TaxId of each match).
+# A match is kept if it matches any 'keep' rule (when there are some) and no 'remove' rule.
+
+# Parse a rule given on the command line, 'Rank=name1,name2' or 'taxid=1234,5678'
+def parse_filter_rule(action, text):
+    column, sep, values = text.partition("=")
+    column = column.strip()
+    if column.lower() == 'taxid':
+        column = 'taxid'
+    if not sep or column not in merge_ranks + ['taxid']:
+        raise ValueError("Invalid filter %s, use Rank=name1,name2 (Rank is one of %s) or taxid=1234,5678"
+                         %(text, ", ".join(merge_ranks)))
+    values = [value.strip() for value in values.split(",") if value.strip()]
+    if column == 'taxid' and not all(value.isdigit() for value in values):
+        raise ValueError("Invalid filter %s, taxids must be numbers" %(text))
+    return [action, column, values]
+
+
+# Compile the rules once into (action, column, set of values). Taxid rules are expanded
+# into the set of taxids of their clades (with the taxonomy database taxfile)
+def compile_filters(rules, taxfile=None):
+    filters = []
+    for action, column, values in rules:
+        if column == 'taxid':
+            clades = fNCBItax.get_resolver(taxfile).descendants(values)
+            filters.append((action, 'LCA_TaxId', frozenset(str(taxid) for taxid in clades)))
+        else:
+            filters.append((action, column, frozenset(values)))
+    return filters
+
+
+# Boolean mask of the rows of df that pass the compiled filters. Each distinct value of a
+# column is looked up once in the hashed set of the rule
+def filter_mask(df, filters):
+    keep = None
+    remove = np.zeros(len(df), dtype=bool)
+    for action, column, values in filters:
+        col = pd.Series(df.index) if column == 'Closest_match' else df[column]
+        wanted = [value for value in col.unique() if value in values]
+        match = col.isin(wanted).to_numpy()
+        if action == 'keep':
+            keep = match if keep is None else keep | match
+        else:
+            remove |= match
+    return ~remove if keep is None else keep & ~remove
+
+
+# Read one CCMetagen result file (.ccm.csv) and return its depth by taxon (sample_depths).
+# Only the columns that are needed are parsed: Closest_match, Depth, the ranks down to
+# tax_level and the columns used by the filters. Taxonomy columns are read as strings;
+# the type of Depth is kept (e.g. integer numbers of fragments).
+# The compiled filters are applied before grouping, so excluded matches are never aggregated
+def read_sample(result_fp, tax_level, filters=()):
+    usecols = ['Closest_match', 'Depth'] + [rank for rank in taxon_columns(tax_level) if rank != 'Closest_match']
+    for action, column, values in filters:
+        if column not in usecols:
+            usecols.append(column)
+
+    dtypes = {col: str for col in usecols if col != 'Depth'}
+    df = pd.read_csv(result_fp, sep=',', index_col='Closest_match', usecols=usecols, dtype=dtypes)
+
+    # this is needed because groupby excludes rows with NAs
+    df = df.fillna("NA")
+
+    # keep or remove taxa:
+    if filters:
+        df = df[filter_mask(df, filters)]
+
+    return sample_depths(df, tax_level)
+
+
+# compiled filters of the worker processes, sent once to each worker
+_filters = ()
+
+def _init_reader(filters):
+    global _filters
+    _filters = filters
+
+
+def _read_sample_job(job):
+    sample_name, result_fp, tax_level = job
+    return sample_name, read_sample(result_fp, tax_level, _filters)
+
+
+# The result files (ending in .ccm.csv) of in_folder, as a list of (sample name, path)
+def find_results(in_folder):
+    results = []
+    for file in sorted(os.listdir(in_folder)):
+        if file.endswith(".ccm.csv"):
+            sample_name = file.split(".res.ccm.csv")[0]
+            results.append((sample_name, os.path.join(in_folder, file)))
+    return results
+
+
+# Read the result files (from find_results), with a pool of worker processes if threads > 1.
+# The filter rules are compiled once, and the files are parsed, filtered and grouped in the
+# workers, which only send back the depth by taxon of each sample.
+# Returns a list of (sample name, sample_depths)
+def read_samples(results, tax_level, rules=(), taxfile=None, threads=1):
+    jobs = [(sample_name, result_fp, tax_level) for sample_name, result_fp in results]
+    if not jobs:
+        return []
+    filters = compile_filters(rules, taxfile)
+
+    if threads > 1 and len(jobs) > 1:
+        pool = Pool(min(threads, len(jobs)), initializer=_init_reader, initargs=(filters,))
+        try:
+            return pool.map(_read_sample_job, jobs, chunksize=max(1, len(jobs) // (threads * 4)))
+        finally:
+            pool.close()
+            pool.join()
+    _init_reader(filters)
+    return [_read_sample_job(job) for job in jobs]
+
+
+##### Incremental merge
+
+# The depth by taxon of each sample is kept in a store folder next to the merged table:
+#   manifest.tsv    the merge options the store was built with (tax_level, filter rules and, with taxid
+#                   filters, the taxonomy database; first line), then the sample, path, size and
+#                   modification time of each result file, and its store file
+#   samples/        one pickled sample_depths per result file
+# When merging again with the same options, only new or modified result files are read.
+# When the options change, the store is cleared and all result files are read again.
+manifest_columns = ['sample', 'path', 'size', 'mtime_ns', 'store_file']
+
+
+# Remove the sample files of the store
+def _clear_store(samples_dir):
+    if not os.path.isdir(samples_dir):
+        return
+    for store_file in os.listdir(samples_dir):
+        if store_file.endswith(".pkl"):
+            os.remove(os.path.join(samples_dir, store_file))
+
+
+def _load_store(store_dir, options):
+    samples_dir = os.path.join(store_dir, 'samples')
+    try:
+        with open(os.path.join(store_dir, 'manifest.tsv'), newline='') as manifest_file:
+            if json.loads(manifest_file.readline().split("\t", 1)[1]) != options:
+                print ("Merge options changed, all result files will be read again.")
+                _clear_store(samples_dir)
+                return {}
+            reader = csv.DictReader(manifest_file, delimiter='\t')
+            return {row['path']: row for row in reader}
+    except (OSError, ValueError, IndexError):
+        # no (valid) manifest: sample files left in the store belong to no result file
+        _clear_store(samples_dir)
+        return {}
+
+
+# Same as read_samples, but only the new or modified result files are read; the other
+# samples are loaded from the store (store_dir), which is then updated.
+# Returns a list of (sample name, sample_depths) and the number of files read
+def read_samples_incremental(results, store_dir, tax_level, rules=(), taxfile=None, threads=1):
+    options = {'tax_level': tax_level, 'filters': [list(rule[:2]) + [list(rule[2])] for rule in rules]}
+    if any(rule[1] == 'taxid' for rule in rules):
+        # (the clades are expanded again when another or an updated taxonomy database is used)
+        options['taxonomy'] = fNCBItax.taxonomy_version(taxfile)
+    manifest = _load_store(store_dir, options)
+    samples_dir = os.path.join(store_dir, 'samples')
+    os.makedirs(samples_dir, exist_ok=True)
+
+    samples = []
+    new_manifest = {}
+    to_read = []
+    for sample_name, result_fp in results:
+        stat = os.stat(result_fp)
+        entry = {'sample': sample_name, 'path': result_fp, 'size': str(stat.st_size),
+                 'mtime_ns': str(stat.st_mtime_ns), 'store_file': None}
+        old = manifest.get(result_fp)
+        if (old is not None and old['sample'] == sample_name and old['size'] == entry['size'] and
+                old['mtime_ns'] == entry['mtime_ns'] and os.path.isfile(os.path.join(samples_dir, old['store_file']))):
+            entry['store_file'] = old['store_file']
+            samples.append((sample_name, pd.read_pickle(os.path.join(samples_dir, old['store_file']))))
+        else:
+            to_read.append((sample_name, result_fp))
+        new_manifest[result_fp] = entry
+
+    # read the new and modified files and add them to the store
+    used = {entry['store_file'] for entry in new_manifest.values() if entry['store_file'] is not None}
+    next_id = 0
+    for (sample_name, result_fp), (name, depths) in zip(to_read, read_samples(to_read, tax_level, rules,
+                                                                              taxfile, threads)):
+        while "%i.pkl" %(next_id) in used:
+            next_id += 1
+        store_file = "%i.pkl" %(next_id)
+        used.add(store_file)
+        depths.to_pickle(os.path.join(samples_dir, store_file))
+        new_manifest[result_fp]['store_file'] = store_file
+        samples.append((sample_name, depths))
+
+    # forget the results that are no longer in the folder
+    for path, entry in manifest.items():
+        if entry['store_file'] not in used:
+            try:
+                os.remove(os.path.join(samples_dir, entry['store_file']))
+            except OSError:
+                pass
+
+    # the manifest is replaced at the end, so an interrupted merge leaves a valid store
+    manifest_tmp = os.path.join(store_dir, 'manifest.tsv.tmp')
+    with open(manifest_tmp, 'w', newline='') as manifest_file:
+        manifest_file.write("#options\t%s\n" %(json.dumps(options)))
+        writer = csv.DictWriter(manifest_file, fieldnames=manifest_columns, delimiter='\t')
+        writer.writeheader()
+        for entry in new_manifest.values():
+            writer.writerow(entry)
+    os.replace(manifest_tmp, os.path.join(store_dir, 'manifest.tsv'))
+
+    return samples, len(to_read)
+
+
+# Aggregate the depths of samples (from read_samples, at a finer level) to tax_level:
+# sums over the ranks below tax_level, without reading the files again
+def rollup(samples, tax_level):
+    levels = list(range(len(taxon_columns(tax_level))))
+    return [(name, depths.groupby(level=levels).sum()) for name, depths in samples]
+
+
+# Build the merged table from a list of (sample name, sample_depths) in a single pass.
+# Returns a DataFrame with one sparse column per sample (sorted by name, absent taxa are 0)
+# and the taxonomy columns, with one row per taxon (sorted by taxonomy)
+def build_matrix(samples, tax_level):
+    tax_cols = taxon_columns(tax_level)
+    samples = sorted(samples, key=lambda sample: sample[0])
+
+    # (sample, taxon, depth) triplets of all samples
+    lengths = [len(depths) for name, depths in samples]
+    nonempty = [depths for name, depths in samples if len(depths)]
+    if nonempty:
+        keys = pd.concat(nonempty).index
+        if not isinstance(keys, pd.MultiIndex):
+            keys = pd.MultiIndex.from_arrays([keys], names=tax_cols)
+
+        # number the distinct taxa in sorted order
+        taxon_codes, taxa = pd.factorize(keys)
+        taxa, order = taxa.sort_values(return_indexer=True)
+        rank_of = np.empty(len(order), dtype=np.int64)
+        rank_of[order] = np.arange(len(order))
+        taxon_codes = rank_of[taxon_codes]
+    else:
+        # no samples, or no taxa left after filtering: a table without rows
+        taxa = pd.MultiIndex.from_arrays([[] for col in tax_cols], names=tax_cols)
+        taxon_codes = np.zeros(0, dtype=np.int64)
+    n_taxa = len(taxa)
+
+    columns = {}
+    start = 0
+    for (name, depths), length in zip(samples, lengths):
+        rows = taxon_codes[start:start + length]
+        start += length
+        if length == 0:
+            values = np.zeros(n_taxa, dtype=np.int64)
+        elif length == n_taxa:
+            values = np.empty(n_taxa, dtype=depths.dtype)
+            values[rows] = depths.to_numpy()
+        else:
+            # absent taxa make the column float, as when aligning the samples with pandas
+            values = np.zeros(n_taxa, dtype=np.result_type(depths.dtype, np.float64))
+            values[rows] = depths.to_numpy()
+        columns[name] = pd.arrays.SparseArray(values, fill_value=values.dtype.type(0))
+
+    matrix = pd.DataFrame(columns, index=pd.RangeIndex(n_taxa))
+    taxonomy = taxa.to_frame(index=False)
+    taxonomy.columns = tax_cols
+    return pd.concat([matrix, taxonomy], axis=1)
+
+
+# The merged table in long format: one row per sample and taxon with a depth above 0
+# (columns Sample, the taxonomy columns and Depth), read from the sparse sample columns
+def long_table(merged, tax_level):
+    tax_cols = taxon_columns(tax_level)
+    sample_cols = [col for col in merged.columns if col not in tax_cols]
+
+    rows, names, depths = [], [], []
+    for name in sample_cols:
+        values = merged[name].array
+        if isinstance(values, pd.arrays.SparseArray) and values.fill_value == 0:
+            positions, present = values.sp_index.indices, values.sp_values
+        else:
+            present = np.asarray(values)
+            positions = np.flatnonzero(present)
+            present = present[positions]
+        keep = present != 0
+        rows.append(positions[keep])
+        depths.append(present[keep])
+        names.append(np.full(keep.sum(), name, dtype=object))
+
+    rows = np.concatenate(rows) if rows else np.array([], dtype=np.int64)
+    long = merged[tax_cols].take(rows).reset_index(drop=True)
+    long.insert(0, 'Sample', np.concatenate(names) if names else np.array([], dtype=object))
+    long['Depth'] = np.concatenate(depths) if depths else np.array([], dtype=np.float64)
+    return long
+
+
+# Save the merged table as out_base + the extension of fmt (see fOutput.table_formats)
+# and return the file name. layout: 'wide' (one column per sample) or 'long' (see long_table).
+# The "NA" added to undefined ranks are removed
+def save_table(merged, tax_level, out_base, fmt='csv', layout='wide'):
+    tax_cols = taxon_columns(tax_level)
+    if layout == 'long':
+        merged = long_table(merged, tax_level)
+        categorical = ['Sample'] + tax_cols
+    else:
+        merged = merged.copy()
+        categorical = tax_cols
+    merged[tax_cols] = merged[tax_cols].replace(["NA"], value = "")
+    return fOutput.save_table(merged, out_base, fmt, index=False, categorical=categorical)
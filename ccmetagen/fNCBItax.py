@@ -11,80 +11,145 @@ Created on 12 Jul 2018
 
 """
 
-from ete3 import NCBITaxa
+import os
+import sqlite3
+from urllib.parse import quote
+
+import pandas as pd
+
 from ccmetagen import cTaxInfo  # where we define classes used here
+from ccmetagen.cAccessionIndex import AccessionIndex
+from ccmetagen.cTaxResolver import TaxResolver, list_of_taxa_ranks
+from ccmetagen.cTaxSnapshot import SNAPSHOT_META, TaxSnapshot, is_snapshot
+
+
+# names given to ranks that are not defined in the lineage
+unknown_rank_names = {'superkingdom': 'unk_sk', 'kingdom': 'unk_k', 'phylum': 'unk_p', 'class': 'unk_c',
+                      'order': 'unk_o', 'family': 'unk_f', 'genus': 'unk_g', 'species': 'unk_s'}
+
+# columns of the lineage table: Superkingdom, Superkingdom_TaxId, Kingdom, ... Species_TaxId
+lineage_columns = [col for rank in list_of_taxa_ranks for col in (rank.capitalize(), rank.capitalize() + "_TaxId")]
+
+
+# same as ete3's DEFAULT_TAXADB and database format version (DB_VERSION), without importing ete3
+default_taxfile = os.path.join(os.environ.get('HOME', '/'), '.etetoolkit', 'taxa.sqlite')
+taxa_sqlite_version = 2
+
+
+# Cheap check that the taxonomy database can be used as it is: a snapshot with the
+# right format version, or an ete3 taxa.sqlite with the expected tables and version.
+# Nothing is downloaded or updated. Returns None if the database is valid,
+# otherwise a message describing the problem.
+# clades: the descendants of taxids will be needed (taxid filters and extraction of clades),
+# for which ete3 also needs the taxa.sqlite.traverse.pkl file written next to its database
+def check_taxonomy(taxfile=None, clades=False):
+    if is_snapshot(taxfile):
+        try:
+            TaxSnapshot(taxfile)
+        except (ValueError, OSError) as err:
+            return str(err)
+        return None
+
+    if taxfile is None:
+        taxfile = default_taxfile
+    if not os.path.isfile(taxfile):
+        return "Taxonomy database not found: %s" %(taxfile)
+
+    try:
+        db = sqlite3.connect("file:%s?mode=ro" %(quote(os.path.abspath(taxfile))), uri=True)
+        try:
+            tables = {row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type='table';")}
+            missing = {'species', 'merged', 'stats'} - tables
+            if missing:
+                return "Taxonomy database %s has no table %s" %(taxfile, ", ".join(sorted(missing)))
+            version = db.execute("SELECT version FROM stats;").fetchone()
+        finally:
+            db.close()
+    except sqlite3.Error as err:
+        return "Cannot read taxonomy database %s: %s" %(taxfile, err)
+
+    if version is None or version[0] != taxa_sqlite_version:
+        return "Taxonomy database %s is outdated (format version %s, expected %s)" %(
+            taxfile, None if version is None else version[0], taxa_sqlite_version)
+
+    if clades and not os.path.isfile(taxfile + ".traverse.pkl"):
+        return ("Taxonomy database %s has no %s.traverse.pkl, needed to find the descendants of taxids. "
+                "Rebuild it with ete3 or use a snapshot built with CCMetagen_build_taxonomy.py" %(taxfile, os.path.basename(taxfile)))
+    return None
+
+
+# The path and modification time of a taxonomy database, so that results derived from it
+# (expanded taxid filters, template lineage tables) can be checked against the database in use
+def taxonomy_version(taxfile=None):
+    if taxfile is None:
+        taxfile = default_taxfile
+    version_fp = os.path.join(taxfile, SNAPSHOT_META) if is_snapshot(taxfile) else taxfile
+    try:
+        return [os.path.abspath(taxfile), str(os.stat(version_fp).st_mtime_ns)]
+    except OSError:
+        return [os.path.abspath(taxfile), None]
+
+
+# one resolver (open taxonomy + lineage cache) per taxonomy file, shared by the whole process
+_resolvers = {}
+
+def get_resolver(taxfile=None):
+    if taxfile not in _resolvers:
+        _resolvers[taxfile] = TaxResolver(taxfile)
+    return _resolvers[taxfile]
+
+
+# Check that index_fp is an accession index (opened and closed again, so that no connection
+# is inherited by worker processes). Returns None if it is, otherwise a message describing the problem
+def check_accession_index(index_fp):
+    try:
+        AccessionIndex(index_fp).close()
+    except (ValueError, sqlite3.Error) as err:
+        return str(err)
+    return None
+
+
+# one accession index (with its cache of looked up accessions) per file, shared by the whole process
+_accession_indexes = {}
+
+def get_accession_index(index_fp):
+    if index_fp not in _accession_indexes:
+        _accession_indexes[index_fp] = AccessionIndex(index_fp)
+    return _accession_indexes[index_fp]
 
 
 def lineage_extractor(query_taxid, TaxInfo_object, taxfile=None):
-    list_of_taxa_ranks = ['superkingdom', 'kingdom', 'phylum', 'class', 'order', 'family','genus', 'species']
-    if taxfile is not None:
-        ncbi = NCBITaxa(taxfile)
-    else:
-        ncbi = NCBITaxa()
-    lineage = ncbi.get_lineage(query_taxid)
-    ranks = ncbi.get_rank(lineage)
-    names = ncbi.get_taxid_translator(lineage)
+    ranks = get_resolver(taxfile).lineage(query_taxid)
 
 # get known data
 
-    for key, val in ranks.items():
-
-        if val == list_of_taxa_ranks[0]:
-            TaxInfo_object.Superkingdom = names[key]
-            TaxInfo_object.Superkingdom_TaxId = key
-
-        elif val == list_of_taxa_ranks[1]:
-            TaxInfo_object.Kingdom = names[key]
-            TaxInfo_object.Kingdom_TaxId = key
-
-        elif val == list_of_taxa_ranks[2]:
-            TaxInfo_object.Phylum = names[key]
-            TaxInfo_object.Phylum_TaxId = key
-
-        elif val == list_of_taxa_ranks[3]:
-            TaxInfo_object.Class = names[key]
-            TaxInfo_object.Class_TaxId = key
-
-        elif val == list_of_taxa_ranks[4]:
-            TaxInfo_object.Order = names[key]
-            TaxInfo_object.Order_TaxId = key
-
-        elif val == list_of_taxa_ranks[5]:
-            TaxInfo_object.Family = names[key]
-            TaxInfo_object.Family_TaxId = key
-
-        elif val == list_of_taxa_ranks[6]:
-            TaxInfo_object.Genus = names[key]
-            TaxInfo_object.Genus_TaxId = key
-
-        elif val == list_of_taxa_ranks[7]:
-            TaxInfo_object.Species = names[key]
-            TaxInfo_object.Species_TaxId = key
+    for rank, (taxid, name) in ranks.items():
+        attr = rank.capitalize()
+        setattr(TaxInfo_object, attr, name)
+        setattr(TaxInfo_object, attr + "_TaxId", taxid)
 
 # fill in the blanks
-    if TaxInfo_object.Superkingdom is None:
-        TaxInfo_object.Superkingdom = "unk_sk"
-
-    if TaxInfo_object.Kingdom is None:
-        TaxInfo_object.Kingdom = "unk_k"
-
-    if TaxInfo_object.Phylum is None:
-        TaxInfo_object.Phylum = "unk_p"
+    for rank, unk_name in unknown_rank_names.items():
+        if getattr(TaxInfo_object, rank.capitalize()) is None:
+            setattr(TaxInfo_object, rank.capitalize(), unk_name)
 
-    if TaxInfo_object.Class is None:
-        TaxInfo_object.Class = "unk_c"
-
-    if TaxInfo_object.Order is None:
-        TaxInfo_object.Order = "unk_o"
-
-    if TaxInfo_object.Family is None:
-        TaxInfo_object.Family = "unk_f"
+    return TaxInfo_object
 
-    if TaxInfo_object.Genus is None:
-        TaxInfo_object.Genus = "unk_g"
 
-    if TaxInfo_object.Species is None:
-        TaxInfo_object.Species = "unk_s"
+# Resolve all taxids at once and return a taxid-indexed DataFrame with the names
+# and taxids of each rank (lineage_columns). Taxids of undefined ranks are <NA>.
+def lineage_table(taxids, taxfile=None):
+    lineages = get_resolver(taxfile).lineages(taxids)
 
+    records = []
+    for taxid, ranks in lineages.items():
+        record = [taxid]
+        for rank in list_of_taxa_ranks:
+            rank_taxid, name = ranks.get(rank, (None, unknown_rank_names[rank]))
+            record.extend((name, rank_taxid))
+        records.append(record)
 
-    return TaxInfo_object
+    table = pd.DataFrame.from_records(records, columns=['TaxId'] + lineage_columns, index='TaxId')
+    taxid_cols = lineage_columns[1::2]
+    table[taxid_cols] = table[taxid_cols].astype('Int64')
+    return table
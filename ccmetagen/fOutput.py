@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Functions to save result tables as csv or in compressed columnar formats
+(Parquet, Feather or HDF5).
+
+The columnar formats need optional packages: pyarrow for Parquet and Feather,
+and PyTables (tables) for HDF5. Taxonomy columns are stored as categoricals
+(dictionary encoded), so each name is stored once per file.
+
+"""
+
+import importlib.util
+
+import pandas as pd
+
+
+# format: (file extension, module needed to write it, package to install)
+table_formats = {'csv': ('.csv', None, None),
+                 'parquet': ('.parquet', 'pyarrow', 'pyarrow'),
+                 'feather': ('.feather', 'pyarrow', 'pyarrow'),
+                 'hdf5': ('.h5', 'tables', 'tables')}
+
+
+# Check that a table format is known and can be written.
+# Returns None if it can, otherwise a message describing the problem
+def check_format(fmt):
+    if fmt not in table_formats:
+        return "Unknown output format %s. Options: %s" %(fmt, ", ".join(table_formats))
+    module, package = table_formats[fmt][1:]
+    if module is not None and importlib.util.find_spec(module) is None:
+        return "The %s output format requires the python package %s (pip install %s)" %(fmt, package, package)
+    return None
+
+
+# Save df as out_base + the extension of fmt, and return the file name.
+# index: save the index of df (as the first column in columnar formats).
+# categorical: columns stored as categoricals in columnar formats
+def save_table(df, out_base, fmt='csv', index=True, categorical=()):
+    out = out_base + table_formats[fmt][0]
+
+    if fmt == 'csv':
+        pd.DataFrame.to_csv(df, out, index=index)
+        return out
+
+    if index:
+        df = df.reset_index()
+    else:
+        df = df.reset_index(drop=True)
+
+    # columnar formats do not store sparse columns, they compress the zeros instead
+    columns = {}
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.SparseDtype):
+            columns[col] = df[col].sparse.to_dense()
+        elif col in categorical:
+            columns[col] = df[col].astype('category')
+    if columns:
+        df = df.assign(**columns)
+
+    if fmt == 'parquet':
+        df.to_parquet(out, compression='zstd', index=False)
+    elif fmt == 'feather':
+        df.to_feather(out, compression='zstd')
+    elif fmt == 'hdf5':
+        # PyTables has no nullable integers: taxids become floats, with NaN for <NA>
+        nullable = [col for col in df.columns if isinstance(df[col].dtype, pd.Int64Dtype)]
+        df = df.astype({col: 'float64' for col in nullable})
+        df.to_hdf(out, key='ccmetagen', mode='w', format='table', complevel=9, complib='zlib')
+    return out
@@ -8,34 +8,234 @@ Created on 1 Aug 2018
 
 
 """
+import os
 import re
+import sqlite3
+
+import pandas as pd
 
 # local imports
-from ccmetagen import cTaxInfo
 from ccmetagen import fNCBItax
+from ccmetagen.cTemplateLineages import TemplateLineages
+
+
+# Layout of the template names (the Closest_match index) of each reference database.
+# Fields are separated by '|' or ' '. Each pattern is matched at the start of the name and
+# must capture the named groups TaxId and Lineage (a description, only used in warnings).
+# It can also capture Accession, used to look up the taxid of templates whose TaxId is
+# 'unk_taxid' in an accession index (CCMetagen.py --acc2taxid).
+# Templates whose TaxId is 'unk_taxid' (or not found) will not get taxonomic ranks.
+header_parsers = {}
+
+def register_header_parser(ref_database, pattern,
+                           warning="WARNING: no NCBI's taxid found for %s\nThis match will not get taxonomic ranks"):
+    # anchored, so that a pattern cannot match in the middle of a name (str.extract searches)
+    pattern = "^(?:%s)" %(pattern)
+    compiled = re.compile(pattern)
+    if not {'TaxId', 'Lineage'} <= set(compiled.groupindex):
+        raise ValueError("The header pattern of %s must have the named groups TaxId and Lineage" %(ref_database))
+    header_parsers[ref_database] = (pattern, warning)
+
+
+# UNITE: <species>|<accession>|<taxid>|<SH>|<refs>|<x>|<lineage>
+register_header_parser("UNITE", r'(?:[^| ]*[| ]){2}(?P<TaxId>[^| ]*)[| ](?:[^| ]*[| ]){3}(?P<Lineage>[^| ]*)',
+                       "WARNING: based on accession number, no taxonomic information was found in NCBI for %s\n"
+                       "This match will not get NCBItax taxonomic ranks")
+
+# RefSeq: <accession>|kraken:taxid|<taxid> <genus> <species> ...
+register_header_parser("RefSeq", r'(?:[^| ]*[| ]){2}(?P<TaxId>[^| ]*)[| ](?P<Lineage>[^| ]*[| ][^| ]*)')
+
+# nt: <taxid>|<accession> <description>
+register_header_parser("nt", r'(?P<TaxId>[^| ]*)[| ](?P<Lineage>(?P<Accession>[^| ]*))',
+                       "WARNING: no NCBI's taxid found for accession %s\nThis match will not get taxonomic ranks")
+
+
+# Parse all template names of a reference database at once.
+# acc2taxid: accession index (see cAccessionIndex) where the accessions of the templates
+# without taxid are looked up, all in one batch. Only opened if there are such templates.
+# Returns a DataFrame with the same index and the columns TaxId (nullable integer) and Lineage
+def parse_headers(index, ref_database, acc2taxid=None, warn=True):
+    pattern = header_parsers[ref_database][0]
+    names = pd.Series(index, index=index, dtype=object)
+    fields = names.str.extract(pattern)
+    headers = fields[['TaxId', 'Lineage']].copy()
+
+    unknown = ~headers['TaxId'].str.fullmatch(r'[0-9]+', na=False)
+
+    # taxid is not a number (unk_taxid): look the accession up in the accession index
+    if acc2taxid is not None and 'Accession' in fields.columns and unknown.any():
+        accessions = fields.loc[unknown, 'Accession']
+        found = fNCBItax.get_accession_index(acc2taxid).taxids(accessions.dropna().unique())
+        if found:
+            resolved = accessions.map(found).dropna()
+            headers.loc[resolved.index, 'TaxId'] = resolved.astype('int64').astype(str)
+            unknown = ~headers['TaxId'].str.fullmatch(r'[0-9]+', na=False)
+
+    # still no taxid: warn
+    if warn:
+        _warn_no_taxid(headers.loc[unknown, 'Lineage'], ref_database)
+
+    headers['TaxId'] = pd.to_numeric(headers['TaxId'].mask(unknown)).astype('Int64')
+    return headers
+
+
+# Warn about templates that get no taxonomic ranks, described by their Lineage field
+def _warn_no_taxid(descriptions, ref_database):
+    warning = header_parsers[ref_database][1]
+    for lineage in descriptions:
+        print ("")
+        print (warning %(lineage))
+        print ("")
+
+
+# Check a template lineage table (see cTemplateLineages): it must have been built for the same
+# reference database and template name layout. Returns None, or a message describing the problem.
+# A table built with another taxonomy database (taxfile) than the one in use, or with an older
+# version of it, can still be used, with a warning
+def check_template_lineages(table_fp, ref_database, taxfile=None):
+    try:
+        table = TemplateLineages(table_fp)
+    except (ValueError, sqlite3.Error) as err:
+        return str(err)
+    meta = table.meta
+    table.close()
+    if meta.get('ref_database') != ref_database or meta.get('header_pattern') != header_parsers[ref_database][0]:
+        return ("The template lineage table %s was built for the reference database %s, not %s. Rebuild it with CCMetagen_build_lineages.py"
+                %(table_fp, meta.get('ref_database'), ref_database))
+
+    taxonomy, taxonomy_mtime = fNCBItax.taxonomy_version(taxfile)
+    if meta.get('taxonomy') != taxonomy or meta.get('taxonomy_mtime') != taxonomy_mtime:
+        print ("")
+        print ("WARNING: the template lineage table %s was built with the taxonomy database %s, not with %s "
+               "as it is now. Its lineages may be outdated: rebuild it with CCMetagen_build_lineages.py"
+               %(table_fp, meta.get('taxonomy'), taxonomy))
+        print ("")
+    return None
+
+
+# one template lineage table per file, shared by the whole process
+_template_lineages = {}
+
+def get_template_lineages(table_fp):
+    if table_fp not in _template_lineages:
+        _template_lineages[table_fp] = TemplateLineages(table_fp)
+    return _template_lineages[table_fp]
 
-import subprocess
 
-# function to filter a res file in pandas df format:
+# Lineages of all template names of a reference database: a DataFrame with the same index and the
+# columns of fNCBItax.lineage_table. The taxids and lineages of the templates found in the precomputed
+# lineage table (lineage_db) are read from it, the other templates are parsed and resolved.
+# The lineages of all distinct taxids are then joined back to the templates at once.
+# Templates whose taxid is not in the taxonomy database are treated as templates without taxid
+def template_lineages(index, ref_database, taxfile=None, acc2taxid=None, lineage_db=None):
+    if lineage_db is None:
+        headers = parse_headers(index, ref_database, acc2taxid)
+        taxids = headers['TaxId']
+        lineages = _resolvable_lineage_table(taxids.dropna().unique(), taxfile, warn=False)
+    else:
+        table = get_template_lineages(lineage_db)
+        taxids = pd.Series(index.map(table.taxids(index.unique())), index=index).astype('Int64')
+        lineages = table.lineage_table(taxids.dropna().unique())
+        rest = taxids.isna().to_numpy()
+        headers = parse_headers(index[rest], ref_database, acc2taxid)
+        taxids[rest] = headers['TaxId'].to_numpy()
+        rest_taxids = headers['TaxId'].dropna().unique()
+        rest_taxids = rest_taxids[~pd.Index(rest_taxids).isin(lineages.index)]
+        if len(rest_taxids) > 0:
+            rest_lineages = _resolvable_lineage_table(rest_taxids, taxfile, warn=False)
+            if len(rest_lineages) > 0:
+                lineages = pd.concat([lineages, rest_lineages])
+
+    # taxids not in the taxonomy database: their templates get no lineage (reindexed to NaN)
+    unresolved = headers['TaxId'].notna() & ~headers['TaxId'].isin(lineages.index)
+    _warn_no_taxid(headers.loc[unresolved, 'Lineage'], ref_database)
+
+    match_lineages = lineages.reindex(taxids.to_numpy())
+    match_lineages.index = index
+    return match_lineages
+
+
+# Resolve the lineages of taxids, leaving out the taxids that are not in the taxonomy database
+# (with a warning if warn). These are found first with a single query (merged taxids are found
+# through their synonyms)
+def _resolvable_lineage_table(taxids, taxfile=None, warn=True):
+    taxids = [int(taxid) for taxid in taxids]
+    found = fNCBItax.get_resolver(taxfile).ncbi.get_taxid_translator(taxids, try_synonyms=True)
+    for taxid in (taxids if warn else []):
+        if taxid not in found:
+            print ("WARNING: taxid %s not found in the taxonomy database, its templates are left out of the table" %(taxid))
+    return fNCBItax.lineage_table([taxid for taxid in taxids if taxid in found], taxfile)
+
+
+# Parse all template names of a KMA database (the .name file written by kma_index), resolve
+# their lineages and save them in a template lineage table (see cTemplateLineages).
+# Names are processed in chunks of chunk_size. Returns the number of names, templates and taxids
+def build_template_lineages(name_fp, table_fp, ref_database, taxfile=None, acc2taxid=None, chunk_size=1000000):
+    counts = {'names': 0}
+
+    def batches():
+        with open(name_fp, encoding='latin1') as names:
+            chunk = []
+            for line in names:
+                chunk.append(line.rstrip("\r\n"))
+                if len(chunk) >= chunk_size:
+                    yield resolve(chunk)
+                    chunk = []
+            if chunk:
+                yield resolve(chunk)
+
+    def resolve(chunk):
+        counts['names'] += len(chunk)
+        taxids = parse_headers(pd.Index(chunk), ref_database, acc2taxid, warn=False)['TaxId'].dropna()
+        lineages = _resolvable_lineage_table(taxids.unique(), taxfile)
+        taxids = taxids[taxids.isin(lineages.index)]
+        return list(zip(taxids.index, taxids.astype('int64').tolist())), lineages
+
+    taxonomy, taxonomy_mtime = fNCBItax.taxonomy_version(taxfile)
+    meta = {'ref_database': ref_database, 'header_pattern': header_parsers[ref_database][0],
+            'source': os.path.abspath(name_fp),
+            'taxonomy': taxonomy, 'taxonomy_mtime': taxonomy_mtime,
+            'acc2taxid': os.path.abspath(acc2taxid) if acc2taxid is not None else ""}
+    n_templates, n_taxids = TemplateLineages.write(table_fp, batches(), meta)
+    return counts['names'], n_templates, n_taxids
+
+
+# column types of a KMA .res file
+res_dtypes = {'#Template': str, 'Score': 'int64', 'Expected': 'int64', 'Template_length': 'int64',
+              'Template_Identity': 'float64', 'Template_Coverage': 'float64', 'Query_Identity': 'float64',
+              'Query_Coverage': 'float64', 'Depth': 'float64', 'q_value': 'float64', 'p_value': 'float64'}
+
+
+# function to filter a res file in pandas df format.
+# Coverage, identity, depth and p-value are checked in a single combined mask
 def res_filter(df,ref_database, cov,Iden,Depth,p):
-    df = df.drop(df[df.Template_Coverage < cov].index)
+    failed = ((df.Template_Coverage < cov) | (df.Query_Identity < Iden) |
+              (df.Depth < Depth) | (df.p_value > p))
+
+    return df[~failed.to_numpy()]
 
-    # filter based on identity      
-    df = df.drop(df[df.Query_Identity < Iden].index)
-    
-    # filter based on depth
-    df = df.drop(df[df.Depth < Depth].index)
 
-    # filter based on p-values
-    df = df.drop(df[df.p_value > p].index)
-     
-    return df
+# Stream a res file in chunks of chunksize lines and only keep the rows that pass res_filter.
+# adjust_depth (optional) is called on each chunk before filtering, e.g. to change depth units.
+def read_res_filtered(res_fp, ref_database, cov, Iden, Depth, p, chunksize, adjust_depth=None):
+    kept = []
+    reader = pd.read_csv(res_fp, sep='\t', index_col=0, encoding='latin1', dtype=res_dtypes, chunksize=chunksize)
+    for chunk in reader:
+        if adjust_depth is not None:
+            chunk = adjust_depth(chunk)
+        kept.append(res_filter(chunk, ref_database, cov, Iden, Depth, p))
+
+    if not kept:
+        # no rows at all, return the empty table
+        return pd.read_csv(res_fp, sep='\t', index_col=0, encoding='latin1', dtype=res_dtypes, nrows=0)
+    return pd.concat(kept)
 
 
 # function that takes as input a pandas dataframe with KMA results 
 # and add tax information to results 
 def populate_w_tax(in_df, ref_database,species_threshold,genus_threshold,
-                   family_threshold,order_threshold,class_threshold,phylum_threshold, taxfile=None):
+                   family_threshold,order_threshold,class_threshold,phylum_threshold, taxfile=None, acc2taxid=None,
+                   lineage_db=None):
     #defaults:
     #species_threshold = 98.41 # Yeast - Vu et al 2016
     #genus_threshold = 96.31 # Yeast - Vu et al 2016
@@ -49,107 +249,33 @@ def populate_w_tax(in_df, ref_database,species_threshold,genus_threshold,
     in_df = in_df.assign(LCA_TaxId="",Superkingdom="",Kingdom="",Phylum="",Class="",Order="",Family="",Genus="",Species="")
 
 
-    # index == the #template (fungal match)
-    for index, row in in_df.iterrows():
-        match_info = cTaxInfo.TaxInfo()
-
-        # define the tax. rank based on similarity:
-        if ref_database == "UNITE":
-            split_match = re.split (r'(\|| )', index)
-            qiden = row['Query_Identity']
-            match_info.Lineage = split_match[12]
-
-            # if taxid is knwon:
-            if split_match[4] != 'unk_taxid':
-                
-                match_info.TaxId = int(split_match[4])
-                match_info = fNCBItax.lineage_extractor(match_info.TaxId , match_info, taxfile)
-                
-                # Warning about unknown taxids: 
-            else:
-                print ("")
-                print ("WARNING: based on accession number, no taxonomic information was found in NCBI for %s" %(match_info.Lineage))
-                print ("This match will not get NCBItax taxonomic ranks")
-                print ("")
-                match_info.TaxId = split_match[4] # 'unk_taxid'
-
-
-        elif ref_database == "RefSeq":
-            split_match = re.split (r'(\|| )', index)
-            qiden = row['Query_Identity']
-            match_info.TaxId = int(split_match[4])
-            species = split_match[6] + " " + split_match[8]
-            match_info.Lineage = species
-            # include info from NCBI:
-            match_info = fNCBItax.lineage_extractor(match_info.TaxId, match_info, taxfile)
-
-
-        elif ref_database == "nt":
-            split_match = re.split (r'(\|| )', index)
-            qiden = row['Query_Identity']
-            match_info.Lineage = split_match[2]
-            
-            #get taxid from accession number
-            taxid = split_match[0]
-
-            if taxid == 'unk_taxid':
-                # Warning about unknown taxids: 
-                print ("")
-                print ("WARNING: no NCBI's taxid found for accession %s" %(match_info.Lineage))
-                print ("This match will not get taxonomic ranks")
-                print ("")
-                
-            else:
-                match_info.TaxId = int(taxid)            
-                match_info = fNCBItax.lineage_extractor(match_info.TaxId, match_info, taxfile)
-   
-            
-        # Populate the df with lineage info and the LCA taxid: 
-        
-        in_df.at[index, 'Superkingdom'] = match_info.Superkingdom
-        in_df.at[index, 'Kingdom'] = match_info.Kingdom
-        
-        # Assign LCA_taxid. Go to Kingdom if possible:
-        in_df.at[index, 'LCA_TaxId'] = match_info.Superkingdom_TaxId
-        
-        if match_info.Kingdom_TaxId is not None:
-            in_df.at[index, 'LCA_TaxId'] = match_info.Kingdom_TaxId
-        
-        # if it matches to uncultured or unclassified fungus, use the Fungi LCA itaxid:
-        if match_info.Kingdom == 'Fungi':
-            in_df.at[index, 'LCA_TaxId'] = 4751
-
-        # fill in the rest of the table according to similarity threshold:
-        if qiden >= phylum_threshold:
-            in_df.at[index, 'Phylum'] = match_info.Phylum
-            if match_info.Phylum_TaxId != None:
-                in_df.at[index, 'LCA_TaxId'] = match_info.Phylum_TaxId
-
-        if qiden >= class_threshold:
-            in_df.at[index, 'Class'] = match_info.Class
-            if match_info.Class_TaxId != None:
-                in_df.at[index, 'LCA_TaxId'] = match_info.Class_TaxId
-    
-        if qiden >= order_threshold:
-            in_df.at[index, 'Order'] = match_info.Order
-            if match_info.Order_TaxId != None:
-                in_df.at[index, 'LCA_TaxId'] = match_info.Order_TaxId
-
-        if qiden >= family_threshold:
-            in_df.at[index, 'Family'] = match_info.Family
-            if match_info.Family_TaxId != None:
-                in_df.at[index, 'LCA_TaxId'] = match_info.Family_TaxId
-    
-        if qiden >= genus_threshold:
-            in_df.at[index, 'Genus'] = match_info.Genus
-            if match_info.Genus_TaxId != None:
-                in_df.at[index, 'LCA_TaxId'] = match_info.Genus_TaxId
-    
-        if qiden >= species_threshold:
-            in_df.at[index, 'Species'] = match_info.Species
-            if match_info.Species_TaxId != None:
-                in_df.at[index, 'LCA_TaxId'] = match_info.Species_TaxId
-    
+    # index == the #template (fungal match). Get the lineage of each template, from the precomputed
+    # lineage table if there is one, or by parsing the template names and resolving the lineages
+    # of all distinct taxids at once:
+    match_lineages = template_lineages(in_df.index, ref_database, taxfile, acc2taxid, lineage_db)
+    qiden = in_df['Query_Identity']
+
+    # Populate the df with lineage info and the LCA taxid, one column at a time:
+    in_df['Superkingdom'] = match_lineages['Superkingdom'].to_numpy()
+    in_df['Kingdom'] = match_lineages['Kingdom'].to_numpy()
+
+    # Assign LCA_taxid. Go to Kingdom if possible:
+    lca = match_lineages['Kingdom_TaxId'].fillna(match_lineages['Superkingdom_TaxId'])
+
+    # if it matches to uncultured or unclassified fungus, use the Fungi LCA itaxid:
+    lca = lca.mask(match_lineages['Kingdom'] == 'Fungi', 4751)
+
+    # fill in the rest of the table according to similarity threshold:
+    thresholds = [('Phylum', phylum_threshold), ('Class', class_threshold), ('Order', order_threshold),
+                  ('Family', family_threshold), ('Genus', genus_threshold), ('Species', species_threshold)]
+
+    for rank, threshold in thresholds:
+        passed = (qiden >= threshold).to_numpy()
+        in_df[rank] = match_lineages[rank].where(passed, "").to_numpy()
+        lca = lca.mask(passed & match_lineages[rank + '_TaxId'].notna(), match_lineages[rank + '_TaxId'])
+
+    in_df['LCA_TaxId'] = lca.array
+
     return in_df
 
 
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Functions that run CCMetagen on KMA results: quality filter, taxonomic
+assignments and output files (csv, krona and mapping stats).
+
+Used by CCMetagen.py, for one .res file or for a batch of samples processed by
+a pool of worker processes that share one taxonomy backend.
+
+"""
+
+import glob
+import os
+import re
+import traceback
+from multiprocessing import Pool
+
+import pandas as pd
+
+# local imports
+from ccmetagen import fParseKMA
+from ccmetagen import fNCBItax
+from ccmetagen import fKrona
+from ccmetagen import cMapstat
+from ccmetagen import fOutput
+
+
+# Adjust depth to reflect number of bases, RPM or number of fragments if needed.
+# Applied to the whole .res table, or to each chunk when streaming
+# mapstat is a cMapstat.Mapstat, needed for 'rpm' and 'fr'
+def adjust_depth(df, du, mapstat=None):
+    if du == 'nc':
+        df['Depth'] = df.Depth * df.Template_length
+    elif du == 'rpm':
+        df['Depth'] = 1000000 * mapstat.table['fragmentCount'] / mapstat.total_frags
+    elif du == 'fr':
+        df['Depth'] = mapstat.table['fragmentCount']
+    return df
+
+
+# Process one KMA result (.res file) and write the output files starting with output_fp.
+# settings is a dict with the CCMetagen.py options (see CCMetagen.py)
+def process_sample(res_fp, output_fp, mapstat, settings):
+    mode = settings['mode']
+    ref_database = settings['ref_database']
+    du = settings['depth_unit']
+    c, q, d, p = settings['coverage'], settings['query_identity'], settings['depth'], settings['pvalue']
+    st, gt, ft, ot, ct, pt = settings['thresholds']
+
+    ##### Read input files and output a pandas dataframe
+    print ("")
+    print ("Reading file %s" %(res_fp))
+    print ("")
+
+    if mapstat is None and (du in ('rpm', 'fr') or settings['extended_output'] == 'y'):
+        raise ValueError("A .mapstat file (--mapstat) is required for -du rpm, -du fr and -ef y")
+
+    # read the mapstat file once, for the depth units and the extended output.
+    # Only the fragment counts are needed unless the table is saved (-ef y)
+    stats = None
+    if mapstat is not None and (du in ('rpm', 'fr') or settings['extended_output'] == 'y'):
+        columns = None if settings['extended_output'] == 'y' else ['fragmentCount']
+        stats = cMapstat.Mapstat(mapstat, columns)
+
+    ##### Quality control + taxonomic assignments
+
+    # quality filter (coverage, query identity, Depth and p-value)
+    if settings['chunksize'] > 0:
+        # streaming: only the rows passing the filter are kept in memory
+        df = fParseKMA.read_res_filtered(res_fp, ref_database, c, q, d, p, settings['chunksize'],
+                                         lambda chunk: adjust_depth(chunk, du, stats))
+    else:
+        df = pd.read_csv(res_fp, sep='\t', index_col=0, encoding='latin1')
+        df = adjust_depth(df, du, stats)
+        df = fParseKMA.res_filter(df, ref_database, c, q, d, p)
+
+    # Rename headers:
+    df.index.name = "Closest_match"
+
+    # add tax info
+    df = fParseKMA.populate_w_tax(df, ref_database, st, gt, ft, ot, ct, pt, settings['taxfile'], settings['acc2taxid'],
+                                   settings['lineage_table'])
+
+
+    ##### Output a file with tax info
+    if (mode == 'text') or (mode == 'both'):
+
+        # save to file (csv by default)
+        fmt = settings.get('output_format', 'csv')
+        out = fOutput.save_table(df, output_fp + ".ccm", fmt, index=True,
+                                 categorical=['Superkingdom','Kingdom','Phylum','Class','Order','Family','Genus','Species'])
+
+        print ("%s file saved as %s" %(fmt, out))
+        print ("")
+
+    ##### Output a Krona file
+    if (mode == 'visual') or (mode == 'both'):
+        krona_info = df[['Depth','Superkingdom','Kingdom','Phylum','Class','Order','Family','Genus','Species']]
+
+        # remove the unk_xx for better krona representation
+        krona_info = krona_info.replace('unk_.*$', value = '',regex=True)
+
+        # save krona file
+        out2 = output_fp + ".html"
+        fKrona.write_krona(krona_info, out2, os.path.basename(output_fp))
+
+        print ("krona file saved as %s" %(out2))
+        print ("")
+
+
+    ##### Extended format - calculate read mapping stats
+    if settings['extended_output'] == 'y':
+        print ("calculating read mapping stats...")
+
+        # delete species in df_stats that are not in the CCM result dataframe:
+        df_stats = stats.table
+        df_stats_filt = df_stats[df_stats.index.isin(df.index)].copy() # the copy handles the pandas warning
+        df_stats_filt['perc_map'] = df_stats_filt['fragmentCount'] / stats.total_frags * 100
+        total_mapped = sum(df_stats_filt['perc_map'])
+
+        stats_out = output_fp + "_stats.csv"
+        pd.DataFrame.to_csv(df_stats_filt, stats_out )
+
+        print ("\nStats file saved as %s" %(stats_out))
+        print ("""\nProportion of reads mapped to the database: %f%%\n""" %(total_mapped))
+
+    return df
+
+
+##### Batch mode
+
+# Find the samples of a batch. batch_input is either:
+#   a folder: all its .res files
+#   a glob pattern, e.g. 'KMA_out/*.res'
+#   a tab-separated manifest, one sample per line: sample name, .res path and (optional) .mapstat path.
+#   Empty lines and lines starting with # are ignored.
+# For folders and globs, the sample name is the .res file name and the .mapstat file
+# next to it is used if it exists. Returns a list of (sample name, .res path, .mapstat path or None)
+def find_samples(batch_input):
+    if os.path.isdir(batch_input):
+        res_files = sorted(glob.glob(os.path.join(batch_input, "*.res")))
+    elif os.path.isfile(batch_input):
+        samples = []
+        with open(batch_input) as manifest:
+            for line in manifest:
+                if not line.strip() or line.startswith("#"):
+                    continue
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) < 2:
+                    raise ValueError("Manifest lines must contain a sample name and a .res path: %s" %(line.strip()))
+                mapstat = fields[2] if len(fields) > 2 and fields[2] else None
+                samples.append((fields[0], fields[1], mapstat))
+        return samples
+    else:
+        res_files = sorted(glob.glob(batch_input))
+
+    samples = []
+    for res_fp in res_files:
+        mapstat = re.sub(r'\.res$', '', res_fp) + ".mapstat"
+        samples.append((os.path.basename(res_fp), res_fp, mapstat if os.path.isfile(mapstat) else None))
+    return samples
+
+
+def _init_worker(settings):
+    if settings.get('header_pattern') is not None:
+        fParseKMA.register_header_parser(settings['ref_database'], settings['header_pattern'])
+    # open the taxonomy once per worker
+    fNCBItax.get_resolver(settings['taxfile']).ncbi
+
+
+def _process_batch_sample(job):
+    sample, res_fp, mapstat, output_fp, settings = job
+    try:
+        process_sample(res_fp, output_fp, mapstat, settings)
+    except Exception:
+        return sample, traceback.format_exc()
+    return sample, None
+
+
+# Process all samples (from find_samples) with a pool of worker processes.
+# Output files are named after the sample, in output_dir, so that the results can be merged
+# with CCMetagen_merge.py. Returns a list of (sample name, error message or None)
+def run_batch(samples, output_dir, settings, threads=1):
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = []
+    for sample, res_fp, mapstat in samples:
+        name = sample if sample.endswith(".res") else sample + ".res"
+        jobs.append((sample, res_fp, mapstat, os.path.join(output_dir, name), settings))
+
+    if threads > 1:
+        pool = Pool(threads, initializer=_init_worker, initargs=(settings,))
+        try:
+            results = pool.map(_process_batch_sample, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_process_batch_sample(job) for job in jobs]
+
+    return results
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Functions to read text files (.frag files, fasta files, ...) that can be gzip
+compressed, whatever their extension, or read from the standard input ('-').
+
+Compressed files are decompressed by pigz (or gzip) in another process, or in
+a separate thread if neither is installed, so decompressing and parsing run at
+the same time.
+
+"""
+
+import gzip
+import io
+import os
+import shutil
+import subprocess
+import sys
+import threading
+from contextlib import contextmanager
+
+
+# True if the binary file f starts with the gzip magic number (f must support peek)
+def is_gzip(f):
+    return f.peek(2)[:2] == b'\x1f\x8b'
+
+
+# Copy the binary file src to dst (a pipe) and close both, in a thread. Decompression errors are
+# added to errors; a broken pipe means that the reader stopped early
+def _copy(src, dst, errors):
+    try:
+        with src, dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+    except BrokenPipeError:
+        pass
+    except Exception as err:
+        errors.append(err)
+
+
+# Open a file as text, decompressing it if it is gzip compressed (whatever the extension).
+# fp can be '-' for the standard input. binary: yield a binary stream instead of text.
+# Use it as a context manager: with open_text(fp) as f: ...
+# Worker processes must be started before, or they keep the input pipe of the decompressor open
+@contextmanager
+def open_text(fp, binary=False):
+    if fp == "-":
+        raw = io.BufferedReader(io.FileIO(os.dup(sys.stdin.fileno()), 'rb'))
+    else:
+        raw = open(fp, 'rb')
+
+    if not is_gzip(raw):
+        with (raw if binary else io.TextIOWrapper(raw)) as text:
+            yield text
+        return
+
+    errors = []
+    threads = []
+    decompressor = shutil.which("pigz") or shutil.which("gzip")
+    if decompressor is None:
+        # inflate in a thread, through a pipe
+        read_fd, write_fd = os.pipe()
+        threads.append(threading.Thread(target=_copy, args=(gzip.GzipFile(fileobj=raw), open(write_fd, 'wb'), errors)))
+        stream = open(read_fd, 'rb')
+        proc = None
+    elif fp == "-":
+        # part of stdin is already in the buffer of raw, so it is passed on by a thread
+        proc = subprocess.Popen([decompressor, "-dc"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        threads.append(threading.Thread(target=_copy, args=(raw, proc.stdin, [])))
+        stream = proc.stdout
+    else:
+        raw.close()
+        proc = subprocess.Popen([decompressor, "-dc", fp], stdout=subprocess.PIPE)
+        stream = proc.stdout
+
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    finished = False
+    text = stream if binary else io.TextIOWrapper(stream)
+    try:
+        yield text
+        finished = True
+    finally:
+        text.close()
+        if proc is not None:
+            if not finished:
+                proc.kill()
+            if proc.wait() != 0 and finished:
+                errors.append("%s exited with code %i" %(decompressor, proc.returncode))
+        if finished:
+            # (otherwise a thread may still be waiting for its input, it stops with the program)
+            for thread in threads:
+                thread.join()
+        if decompressor is None or fp == "-":
+            raw.close()
+    if errors:
+        raise IOError("Could not decompress %s: %s" %(fp, errors[0]))
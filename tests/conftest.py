@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fixtures shared by the tests: a small NCBI taxonomy, built by ete3 from a taxdump
+
+"""
+
+import io
+import os
+import tarfile
+
+import pytest
+
+
+# taxid, parent, rank, name of a small taxonomy (the root is its own parent, as in NCBI's nodes.dmp)
+nodes = [(1, 1, "no rank", "root"),
+         (2759, 1, "superkingdom", "Eukaryota"),
+         (4751, 2759, "kingdom", "Fungi"),
+         (4890, 4751, "phylum", "Ascomycota"),
+         (4891, 4890, "class", "Saccharomycetes"),
+         (4892, 4891, "order", "Saccharomycetales"),
+         (766764, 4892, "family", "Debaryomycetaceae"),
+         (1535326, 766764, "genus", "Candida"),
+         (5476, 1535326, "species", "Candida albicans")]
+merged = [(5477, 5476)]
+
+
+# write an NCBI taxdump with these nodes and let ete3 build its taxa.sqlite from it
+def ete3_taxa_sqlite(folder):
+    ncbiquery = pytest.importorskip("ete3.ncbi_taxonomy.ncbiquery")
+    dmp = {'nodes.dmp': "".join("%i\t|\t%i\t|\t%s\t|\n" %(taxid, parent, rank) for taxid, parent, rank, name in nodes),
+           'names.dmp': "".join("%i\t|\t%s\t|\t\t|\tscientific name\t|\n" %(taxid, name) for taxid, parent, rank, name in nodes),
+           'merged.dmp': "".join("%i\t|\t%i\t|\n" %(old, new) for old, new in merged)}
+    taxdump = os.path.join(folder, "taxdump.tar.gz")
+    with tarfile.open(taxdump, "w:gz") as tar:
+        for member, text in dmp.items():
+            data = text.encode('utf-8')
+            info = tarfile.TarInfo(member)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+    taxfile = os.path.join(folder, "taxa.sqlite")
+    cwd = os.getcwd()
+    os.chdir(folder) # ete3 writes temporary files in the working directory
+    try:
+        ncbiquery.update_db(taxfile, taxdump)
+    finally:
+        os.chdir(cwd)
+    return taxfile
+
+
+# path to the ete3 taxa.sqlite of the small taxonomy, built once
+@pytest.fixture(scope="session")
+def taxfile(tmp_path_factory):
+    return ete3_taxa_sqlite(str(tmp_path_factory.mktemp("taxonomy")))
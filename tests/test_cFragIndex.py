@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the .frag file index (ccmetagen/cFragIndex.py): the reads of a few templates read
+through the index are the same as found by reading the whole file
+
+"""
+
+import gzip
+
+from ccmetagen.cFragIndex import FragIndex, has_index
+
+
+templates = ["%i|AB%06i.1 template %i" %(100 + t, t, t) for t in range(7)]
+
+
+# lines of a KMA .frag file: read, equivalent matches, score, start, end, template, read name
+def frag_lines(n_reads=300):
+    return ["ACGTACGT%s\t1\t%i\t0\t%i\t%s\tread_%i\n" %("A" * (i % 13), 10 + i, 8 + i % 13, templates[(i * 5 + i // 40) % 7], i)
+            for i in range(n_reads)]
+
+
+def check_round_trip(indexed_fp, lines):
+    assert has_index(indexed_fp)
+    index = FragIndex(indexed_fp)
+    for wanted in ([templates[1]], templates[2:5], templates, ["not a template"]):
+        expected = [line for line in lines if line.split("\t")[5] in wanted]
+        found = [line for line in index.read_lines(index.blocks(wanted)) if line.split("\t")[5] in wanted]
+        assert found == expected
+
+
+def test_plain_frag_file(tmp_path):
+    lines = frag_lines()
+    frags_fp = str(tmp_path / "sample.frag")
+    with open(frags_fp, 'w') as frags:
+        frags.writelines(lines)
+
+    indexed_fp, n_reads, n_templates, n_blocks = FragIndex.build(frags_fp, block_size=500)
+    assert (indexed_fp, n_reads, n_templates) == (frags_fp, len(lines), len(templates))
+    assert n_blocks > 1
+    check_round_trip(indexed_fp, lines)
+
+
+def test_compressed_frag_file(tmp_path):
+    lines = frag_lines()
+    frags_fp = str(tmp_path / "sample.frag.gz")
+    with gzip.open(frags_fp, 'wt') as frags:
+        frags.writelines(lines)
+
+    # rewritten as independent gzip blocks, still a valid .gz file
+    out_fp = str(tmp_path / "sample.blocks.frag.gz")
+    indexed_fp, n_reads, n_templates, n_blocks = FragIndex.build(frags_fp, out_fp, block_size=500)
+    assert (indexed_fp, n_reads, n_blocks > 1) == (out_fp, len(lines), True)
+    with gzip.open(out_fp, 'rt') as frags:
+        assert frags.readlines() == lines
+    check_round_trip(indexed_fp, lines)
+
+    # a plain file, block compressed on request
+    plain_fp = str(tmp_path / "sample.frag")
+    with open(plain_fp, 'w') as frags:
+        frags.writelines(lines)
+    indexed_fp = FragIndex.build(plain_fp, str(tmp_path / "compressed.frag.gz"), block_size=500, compress=True)[0]
+    check_round_trip(indexed_fp, lines)
@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the taxonomy snapshot (ccmetagen/cTaxSnapshot.py)
+
+"""
+
+import pytest
+
+ncbiquery = pytest.importorskip("ete3.ncbi_taxonomy.ncbiquery")
+
+from ccmetagen.cTaxSnapshot import TaxSnapshot
+
+
+def test_build_from_ete3_taxa_sqlite(tmp_path, taxfile):
+    snapshot_dir = str(tmp_path / "snapshot")
+
+    n_taxa, n_merged = TaxSnapshot.build(snapshot_dir, taxfile)
+    assert (n_taxa, n_merged) == (9, 1) # (see conftest.py)
+
+    snapshot = TaxSnapshot(snapshot_dir)
+    ncbi = ncbiquery.NCBITaxa(taxfile)
+    assert snapshot.get_lineage(5476) == ncbi.get_lineage(5476)
+    assert snapshot.get_lineage(1) == [1]
+    assert snapshot.get_rank([4751]) == {4751: "kingdom"}
+    assert snapshot.get_taxid_translator([1535326]) == {1535326: "Candida"}
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the merging of CCMetagen results (ccmetagen/fMerge.py)
+
+"""
+
+import os
+
+import pandas as pd
+
+from ccmetagen import fMerge
+from ccmetagen.cTaxSnapshot import TaxSnapshot
+
+
+result_columns = ['Closest_match', 'Depth', 'LCA_TaxId', 'Superkingdom', 'Kingdom', 'Phylum', 'Class',
+                  'Order', 'Family', 'Genus', 'Species']
+
+
+# write a small CCMetagen result file: rows of (template, depth, taxid, kingdom, genus, species)
+def write_result(folder, name, rows):
+    result_fp = os.path.join(folder, name + ".ccm.csv")
+    with open(result_fp, 'w') as result:
+        result.write(",".join(result_columns) + "\n")
+        for template, depth, taxid, kingdom, genus, species in rows:
+            result.write(",".join([template, str(depth), str(taxid), "Eukaryota", kingdom, "", "", "", "",
+                                   genus, species]) + "\n")
+    return result_fp
+
+
+def merge(folder, tax_level, rules=()):
+    samples = fMerge.read_samples(fMerge.find_results(folder), tax_level, rules)
+    return fMerge.build_matrix(samples, tax_level)
+
+
+def test_build_matrix(tmp_path):
+    write_result(str(tmp_path), "s2", [("t1", 2, 5476, "Fungi", "Candida", "Candida albicans"),
+                                       ("t2", 3, 5476, "Fungi", "Candida", "Candida albicans"),
+                                       ("t3", 1, 4932, "Fungi", "Saccharomyces", "Saccharomyces cerevisiae")])
+    write_result(str(tmp_path), "s1", [("t4", 5, 4932, "Fungi", "Saccharomyces", "Saccharomyces cerevisiae")])
+
+    merged = merge(str(tmp_path), "Species")
+    assert list(merged.columns) == ["s1.ccm.csv", "s2.ccm.csv"] + fMerge.taxon_columns("Species")
+    # one row per taxon, sorted by taxonomy; absent taxa are 0
+    assert list(merged['Species']) == ["Candida albicans", "Saccharomyces cerevisiae"]
+    assert list(merged['s1.ccm.csv']) == [0, 5]
+    assert list(merged['s2.ccm.csv']) == [5, 1]
+    assert list(merged['Phylum']) == ["NA", "NA"]
+
+
+def test_rollup(tmp_path):
+    write_result(str(tmp_path), "s1", [("t1", 2, 5476, "Fungi", "Candida", "Candida albicans"),
+                                       ("t2", 3, 5478, "Fungi", "Candida", "Candida glabrata"),
+                                       ("t3", 1, 4932, "Fungi", "Saccharomyces", "Saccharomyces cerevisiae")])
+    samples = fMerge.read_samples(fMerge.find_results(str(tmp_path)), "Species")
+
+    genus = dict(fMerge.rollup(samples, "Genus"))["s1.ccm.csv"]
+    assert genus.index.names == fMerge.taxon_columns("Genus")
+    assert genus.droplevel(list(range(6))).to_dict() == {"Candida": 5, "Saccharomyces": 1}
+    assert fMerge.build_matrix(fMerge.rollup(samples, "Genus"), "Genus").equals(merge(str(tmp_path), "Genus"))
+
+
+def test_filter_mask(tmp_path, taxfile):
+    df = pd.DataFrame({'Genus': ["Candida", "Saccharomyces", "Candida"], 'LCA_TaxId': ["5476", "4932", "1"]},
+                      index=["t1", "t2", "t3"])
+    assert list(fMerge.filter_mask(df, fMerge.compile_filters([["keep", "Genus", ["Candida"]]]))) == [True, False, True]
+    assert list(fMerge.filter_mask(df, fMerge.compile_filters([["keep", "Genus", ["Candida"]],
+                                                               ["remove", "Closest_match", ["t3"]]]))) == [True, False, False]
+    assert list(fMerge.filter_mask(df, [])) == [True, True, True]
+
+    # taxid rules keep the whole clade, through the taxonomy database
+    snapshot_dir = str(tmp_path / "snapshot")
+    TaxSnapshot.build(snapshot_dir, taxfile)
+    filters = fMerge.compile_filters([["keep", "taxid", ["4751"]]], snapshot_dir)
+    assert list(fMerge.filter_mask(df, filters)) == [True, False, False]
+
+
+def test_all_taxa_filtered_out(tmp_path):
+    write_result(str(tmp_path), "s1", [("t1", 2.0, 5476, "Fungi", "Candida", "Candida albicans")])
+    write_result(str(tmp_path), "s2", [("t2", 1.0, 4932, "Fungi", "Saccharomyces", "Saccharomyces cerevisiae")])
+
+    merged = merge(str(tmp_path), "Genus", [["keep", "Kingdom", ["Nothing"]]])
+    assert len(merged) == 0
+    assert list(merged.columns) == ["s1.ccm.csv", "s2.ccm.csv"] + fMerge.taxon_columns("Genus")
+
+    # as without filters, a table with only the header is written
+    out = fMerge.save_table(merged, "Genus", str(tmp_path / "merged"))
+    with open(out) as table:
+        assert table.read() == "s1.ccm.csv,s2.ccm.csv,Superkingdom,Kingdom,Phylum,Class,Order,Family,Genus\n"
+
+    out = fMerge.save_table(merged, "Genus", str(tmp_path / "merged_long"), layout='long')
+    with open(out) as table:
+        assert table.read() == "Sample,Superkingdom,Kingdom,Phylum,Class,Order,Family,Genus,Depth\n"
+
+
+def test_empty_input_folder(tmp_path):
+    merged = merge(str(tmp_path), "Species")
+    assert len(merged) == 0
+    assert list(merged.columns) == fMerge.taxon_columns("Species")
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the parsing of template names and of the taxonomic ranks of matches (ccmetagen/fParseKMA.py),
+against the small taxonomy of conftest.py
+
+"""
+
+import pandas as pd
+
+from ccmetagen import fParseKMA
+from ccmetagen.cAccessionIndex import AccessionIndex
+
+
+# KMA matches of nt templates, with their query identity
+def matches(templates, identity=100.0):
+    return pd.DataFrame({'Query_Identity': identity}, index=pd.Index(templates, name='#Template'))
+
+
+def test_parse_headers():
+    nt = fParseKMA.parse_headers(pd.Index(["5476|AB000003.1 Candida albicans", "unk_taxid|AB000001.1 Candida"]), "nt",
+                                 warn=False)
+    assert list(nt['TaxId']) == [5476, pd.NA]
+    assert list(nt['Lineage']) == ["AB000003.1", "AB000001.1"]
+
+    refseq = fParseKMA.parse_headers(pd.Index(["NC_032089.1|kraken:taxid|5476 Candida albicans chromosome 1"]), "RefSeq")
+    assert list(refseq['TaxId']) == [5476]
+    assert list(refseq['Lineage']) == ["Candida albicans"]
+
+    unite = fParseKMA.parse_headers(pd.Index(["Candida_albicans|KP131676|5476|SH1507562.08FU|refs|k|k__Fungi;p__Ascomycota"]),
+                                    "UNITE")
+    assert list(unite['TaxId']) == [5476]
+    assert list(unite['Lineage']) == ["k__Fungi;p__Ascomycota"]
+
+    # patterns are anchored at the start of the template name
+    shifted = fParseKMA.parse_headers(pd.Index(["x 5476|AB000003.1 Candida albicans"]), "nt", warn=False)
+    assert list(shifted['TaxId']) == [pd.NA]
+
+
+def test_populate_w_tax(taxfile):
+    templates = ["5476|AB000003.1 Candida albicans", "5476|AB000005.1 Candida albicans",
+                 "5477|AB000006.1 Candida albicans (merged taxid)", "4751|AB000007.1 Fungi"]
+    df = matches(templates)
+    df['Query_Identity'] = [100.0, 97.0, 99.0, 100.0]
+    df = fParseKMA.populate_w_tax(df, "nt", 98.41, 96.31, 88.51, 81.21, 80.91, 0, taxfile)
+
+    assert list(df['Kingdom']) == ["Fungi"] * 4
+    # ranks below the identity thresholds are left empty and the LCA is the lowest rank kept
+    assert list(df['Species']) == ["Candida albicans", "", "Candida albicans", "unk_s"]
+    assert list(df['Genus']) == ["Candida", "Candida", "Candida", "unk_g"]
+    assert list(df['LCA_TaxId']) == [5476, 1535326, 5476, 4751]
+
+
+def test_taxid_not_in_taxonomy(tmp_path, taxfile, capsys):
+    # the accession index and a template name give taxids that are not in the taxonomy
+    map_fp = str(tmp_path / "acc.map")
+    with open(map_fp, 'w') as acc_map:
+        acc_map.write("AB000001.1\t5476\nAB000002.1\t999999\n")
+    acc2taxid = str(tmp_path / "acc.sqlite")
+    AccessionIndex.build(map_fp, acc2taxid)
+
+    templates = ["5476|AB000003.1 Candida albicans", "unk_taxid|AB000001.1 Candida albicans",
+                 "unk_taxid|AB000002.1 unknown", "888888|AB000004.1 unknown"]
+    names_fp = str(tmp_path / "nt.name")
+    with open(names_fp, 'w') as names:
+        names.write("\n".join(templates) + "\n")
+    lineage_db = str(tmp_path / "nt.lineages.sqlite")
+    fParseKMA.build_template_lineages(names_fp, lineage_db, "nt", taxfile, acc2taxid)
+    capsys.readouterr()
+
+    for table in (None, lineage_db):
+        df = fParseKMA.populate_w_tax(matches(templates), "nt", 98.41, 96.31, 88.51, 81.21, 80.91, 0,
+                                      taxfile, acc2taxid, table)
+        # the templates of these taxids are left without taxonomic ranks, as templates without taxid
+        assert list(df['Species'][:2]) == ["Candida albicans", "Candida albicans"]
+        assert list(df['LCA_TaxId'][:2]) == [5476, 5476]
+        assert df.iloc[2:][['LCA_TaxId', 'Kingdom', 'Species']].isna().all(axis=None)
+
+        out = capsys.readouterr().out
+        assert "no NCBI's taxid found for accession AB000002.1" in out
+        assert "no NCBI's taxid found for accession AB000004.1" in out